@@ -0,0 +1,203 @@
+import json
+import time
+import subprocess
+import torch
+from glow import WaveGlow, WaveGlowLoss, InferenceWorkspace
+
+# float16/bfloat16 run infer under autocast, as inference.py --precision does
+DTYPES = {'float32': None, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+def build_waveglow(waveglow_config, seed=1234):
+    """WaveGlow with random weights, the end layers too so that the flows are not trivial"""
+    torch.manual_seed(seed)
+    model = WaveGlow(**waveglow_config)
+    for wn in list(model.WN1) + list(model.WN2):
+        torch.nn.init.normal_(wn.end.weight, std=0.01)
+        torch.nn.init.normal_(wn.end.bias, std=0.01)
+    return model
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_call(fn, device, warmup=1, repeats=3):
+    """Median wall time of fn over repeats calls after warmup calls"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        st = time.time()
+        fn()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.time() - st)
+    return sorted(times)[len(times) // 2]
+
+
+def bench_infer(model, n_frames, batch_size, device, hop_length, sampling_rate,
+                warmup=1, repeats=3):
+    spect = torch.randn(batch_size, model.upsample.in_channels, n_frames,
+                        device=device)
+    workspace = InferenceWorkspace()
+
+    def step():
+        with torch.no_grad():
+            model.infer(spect, sigma=0.6, workspace=workspace)
+    seconds = time_call(step, device, warmup, repeats)
+    n_samples = batch_size * n_frames * hop_length
+    return seconds, n_samples / float(sampling_rate)
+
+
+def bench_train(model, segment_length, batch_size, device, hop_length,
+                sampling_rate, warmup=1, repeats=3):
+    """One forward + WaveGlowLoss + backward on random segments"""
+    criterion = WaveGlowLoss()
+    n_frames = segment_length // hop_length + 1
+    spect = torch.randn(batch_size, model.upsample.in_channels, n_frames,
+                        device=device)
+    audio = torch.rand(batch_size, segment_length, device=device) * 2 - 1
+
+    def step():
+        model.zero_grad()
+        loss = criterion(model((spect, audio)))
+        loss.backward()
+    seconds = time_call(step, device, warmup, repeats)
+    return seconds, batch_size * segment_length / float(sampling_rate)
+
+
+def result(kind, seconds, audio_seconds, sampling_rate, **key):
+    key.update({'kind': kind,
+                'seconds': seconds,
+                'samples_per_second': audio_seconds * sampling_rate / seconds,
+                'rtf': seconds / audio_seconds})
+    return key
+
+
+def run(config, device='cpu', lengths=(64, 256), batch_sizes=(1, 4),
+        dtypes=('float32',), threads=(0,), train_batch_size=1, train=True,
+        warmup=1, repeats=3):
+    waveglow_config = config['waveglow_config']
+    data_config = config['data_config']
+    hop_length = data_config['hop_length']
+    sampling_rate = data_config['sampling_rate']
+    results = []
+    default_threads = torch.get_num_threads()
+    for num_threads in threads:
+        torch.set_num_threads(num_threads if num_threads > 0 else default_threads)
+        num_threads = torch.get_num_threads()
+        if train:
+            model = build_waveglow(waveglow_config).to(device).train()
+            seconds, audio_seconds = bench_train(
+                model, data_config['segment_length'], train_batch_size, device,
+                hop_length, sampling_rate, warmup, repeats)
+            results.append(result('train', seconds, audio_seconds, sampling_rate,
+                                  device=device, dtype='float32',
+                                  threads=num_threads, batch_size=train_batch_size,
+                                  frames=data_config['segment_length'] // hop_length))
+            print(results[-1])
+            del model
+        model = build_waveglow(waveglow_config)
+        model = model.remove_weightnorm(model).to(device)
+        for dtype in dtypes:
+            if dtype == 'float16' and device != 'cuda':
+                print("skipping float16, autocast on CPU is bfloat16 only")
+                continue
+            model = model.set_precision(DTYPES[dtype]).optimize_for_inference()
+            for batch_size in batch_sizes:
+                for n_frames in lengths:
+                    try:
+                        seconds, audio_seconds = bench_infer(
+                            model, n_frames, batch_size, device, hop_length,
+                            sampling_rate, warmup, repeats)
+                    except RuntimeError as e:
+                        # e.g. out of memory for the longest batches
+                        print("skipping {} batch {} frames {}: {}".format(
+                            dtype, batch_size, n_frames, e))
+                        continue
+                    results.append(result('infer', seconds, audio_seconds,
+                                          sampling_rate, device=device,
+                                          dtype=dtype, threads=num_threads,
+                                          batch_size=batch_size, frames=n_frames))
+                    print(results[-1])
+    torch.set_num_threads(default_threads)
+    return results
+
+
+def result_key(r):
+    return (r['kind'], r['device'], r['dtype'], r['threads'], r['batch_size'],
+            r['frames'])
+
+
+def compare(results, baseline, threshold=0.1):
+    """
+    Prints the change in seconds of every configuration also in baseline
+    and returns the ones slower by more than threshold (0.1 = 10%)
+    """
+    baseline = {result_key(r): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        if result_key(r) not in baseline:
+            continue
+        change = r['seconds'] / baseline[result_key(r)]['seconds'] - 1
+        print("{:<50s} {:+.1%}".format(str(result_key(r)), change))
+        if change > threshold:
+            regressions.append(r)
+    return regressions
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', default='config.json',
+                        help='JSON file with waveglow_config and data_config')
+    parser.add_argument('--device', default=None,
+                        help='cuda or cpu, defaults to cuda when available')
+    parser.add_argument('--lengths', default=[64, 256], type=int, nargs='+',
+                        help='mel frames per utterance')
+    parser.add_argument('--batch_sizes', default=[1, 4], type=int, nargs='+')
+    parser.add_argument('--dtypes', default=['float32'], nargs='+',
+                        choices=sorted(DTYPES))
+    parser.add_argument('--threads', default=[0], type=int, nargs='+',
+                        help='CPU thread counts, 0 keeps the default')
+    parser.add_argument('--train_batch_size', default=1, type=int)
+    parser.add_argument('--no_train', action='store_true',
+                        help='skip timing the training step')
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the results as a JSON baseline')
+    parser.add_argument('--compare', default=None,
+                        help='baseline JSON to compare against')
+    parser.add_argument('--threshold', default=0.1, type=float,
+                        help='slowdown counted as a regression, 0.1 = 10%%')
+    args = parser.parse_args()
+
+    if args.device is None:
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    with open(args.config) as f:
+        config = json.loads(f.read())
+    results = run(config, args.device, args.lengths, args.batch_sizes,
+                  args.dtypes, args.threads, args.train_batch_size,
+                  not args.no_train, args.warmup, args.repeats)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(),
+                       'torch': torch.__version__,
+                       'waveglow_config': config['waveglow_config'],
+                       'results': results}, f, indent=4)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("compared with {}".format(baseline.get('commit')))
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
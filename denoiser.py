@@ -1,7 +1,6 @@
-import sys
-sys.path.append('tacotron2')
 import torch
-from layers import STFT
+from frontend import STFT
+from glow import profile
 
 
 class Denoiser(torch.nn.Module):
@@ -12,7 +11,8 @@ class Denoiser(torch.nn.Module):
         super(Denoiser, self).__init__()
         self.stft = STFT(filter_length=filter_length,
                          hop_length=int(filter_length/n_overlap),
-                         win_length=win_length).cuda()
+                         win_length=win_length).to(
+                             waveglow.upsample.weight.device)
         if mode == 'zeros':
             mel_input = torch.zeros(
                 (1, 80, 88),
@@ -33,8 +33,10 @@ class Denoiser(torch.nn.Module):
         self.register_buffer('bias_spec', bias_spec[:, :, 0][:, :, None])
 
     def forward(self, audio, strength=0.1):
-        audio_spec, audio_angles = self.stft.transform(audio.cuda().float())
-        audio_spec_denoised = audio_spec - self.bias_spec * strength
-        audio_spec_denoised = torch.clamp(audio_spec_denoised, 0.0)
-        audio_denoised = self.stft.inverse(audio_spec_denoised, audio_angles)
+        with profile('denoiser'):
+            audio_spec, audio_angles = self.stft.transform(
+                audio.to(self.bias_spec.device).float())
+            audio_spec_denoised = audio_spec - self.bias_spec * strength
+            audio_spec_denoised = torch.clamp(audio_spec_denoised, 0.0)
+            audio_denoised = self.stft.inverse(audio_spec_denoised, audio_angles)
         return audio_denoised
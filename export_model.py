@@ -0,0 +1,79 @@
+import json
+import argparse
+import torch
+
+
+class InferenceGraph(torch.nn.Module):
+    """
+    The reverse pass of a WaveGlow with the noise as an input, so that it can
+    be traced.  z is unit normal noise of shape batch x n_group x
+    (frames*hop_length/n_group), already multiplied by sigma.
+    """
+    def __init__(self, waveglow):
+        super(InferenceGraph, self).__init__()
+        self.waveglow = waveglow
+
+    def forward(self, spect, z):
+        return self.waveglow.infer(spect, sigma=1.0, z=z)
+
+
+def prepare_for_export(waveglow):
+    """
+    Folds weight norm into the conv weights and computes every
+    Invertible1x1Conv inverse ahead of time, so neither ends up in the graph.
+    The other weights infer derives (see WaveGlow.keep_weights) are not kept
+    while tracing, so the graph reads them from the parameters.
+    """
+    waveglow = waveglow.remove_weightnorm(waveglow)
+    return waveglow.optimize_for_inference()
+
+
+def export(waveglow_path, output_path, export_format='torchscript', n_frames=64,
+           opset_version=13):
+    waveglow = torch.load(waveglow_path, map_location='cpu')['model']
+    waveglow = prepare_for_export(waveglow)
+    graph = InferenceGraph(waveglow)
+
+    hop_length = waveglow.upsample.stride[0]
+    n_mel_channels = waveglow.upsample.in_channels
+    spect = torch.randn(1, n_mel_channels, n_frames)
+    z = torch.randn(1, waveglow.n_group, n_frames*hop_length // waveglow.n_group)
+
+    with torch.no_grad():
+        if export_format == 'torchscript':
+            traced = torch.jit.trace(graph, (spect, z), check_trace=False)
+            traced.save(output_path)
+        elif export_format == 'onnx':
+            torch.onnx.export(graph, (spect, z), output_path,
+                              input_names=['spect', 'z'],
+                              output_names=['audio'],
+                              dynamic_axes={'spect': {0: 'batch', 2: 'frames'},
+                                            'z': {0: 'batch', 2: 'groups'},
+                                            'audio': {0: 'batch', 1: 'samples'}},
+                              opset_version=opset_version)
+        else:
+            raise Exception("Format {} is not supported".format(export_format))
+
+    # everything the runtime needs to draw z, it never imports glow.py
+    config = {'format': export_format,
+              'n_mel_channels': n_mel_channels,
+              'n_group': waveglow.n_group,
+              'hop_length': hop_length}
+    with open(output_path + '.json', 'w') as f:
+        json.dump(config, f, indent=4)
+    print("Exported {} to {}".format(waveglow_path, output_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--waveglow_path', required=True,
+                        help='Path to waveglow decoder checkpoint with model')
+    parser.add_argument('-o', '--output_path', required=True)
+    parser.add_argument('--format', default='torchscript',
+                        choices=['torchscript', 'onnx'])
+    parser.add_argument('--n_frames', default=64, type=int,
+                        help='mel length of the example input used for tracing')
+    parser.add_argument('--opset_version', default=13, type=int)
+    args = parser.parse_args()
+    export(args.waveglow_path, args.output_path, args.format, args.n_frames,
+           args.opset_version)
@@ -0,0 +1,252 @@
+import os
+import json
+import random
+import collections
+import multiprocessing
+import numpy as np
+import torch
+import torch.utils.data
+from frontend import TacotronSTFT
+from mel2samp import files_to_list, load_wav_to_torch, MAX_WAV_VALUE, \
+    voiced_ranges, run_counts, sample_start
+
+# 特征库index里记录的mel参数
+MEL_CONFIG_KEYS = ('sampling_rate', 'filter_length', 'hop_length', 'win_length',
+                   'mel_fmin', 'mel_fmax')
+
+
+class ShardWriter(object):
+    """
+    Appends named utterances made of arrays (e.g. audio, mel) to shards of
+    about shard_bytes.  Every key of a shard is one .npy with the arrays of
+    all its utterances concatenated on axis 0, and index.json gives the
+    shard, offset and length of each utterance per key.
+    """
+    def __init__(self, path, shard_bytes=2**30, config=None):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.shard_bytes = shard_bytes
+        self.index = {'config': config or {}, 'shards': [], 'utterances': []}
+        self.pending = collections.defaultdict(list)
+        self.pending_bytes = 0
+        self.offsets = collections.defaultdict(int)
+
+    def add(self, name, info=None, **arrays):
+        """info is stored as is in the utterance's index entry"""
+        entry = dict(info or {}, name=name, shard=len(self.index['shards']))
+        for key, array in arrays.items():
+            entry[key] = [self.offsets[key], len(array)]
+            self.offsets[key] += len(array)
+            self.pending[key].append(array)
+            self.pending_bytes += array.nbytes
+        self.index['utterances'].append(entry)
+        if self.pending_bytes >= self.shard_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        shard = 'shard{:04d}'.format(len(self.index['shards']))
+        for key, arrays in self.pending.items():
+            np.save(os.path.join(self.path, '{}.{}.npy'.format(shard, key)),
+                    np.concatenate(arrays))
+        self.index['shards'].append(shard)
+        self.pending = collections.defaultdict(list)
+        self.pending_bytes = 0
+        self.offsets = collections.defaultdict(int)
+
+    def close(self):
+        self.flush()
+        # index最后写，读到index时shard一定是完整的
+        index_path = os.path.join(self.path, 'index.json')
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+
+class ShardReader(object):
+    """
+    Reads a directory written by ShardWriter.  Shards are memory-mapped on
+    first use, so a reader can be created before DataLoader workers fork
+    and slicing an utterance only touches the pages it needs.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.path = path
+        self.config = index['config']
+        self.shards = index['shards']
+        self.utterances = index['utterances']
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.utterances)
+
+    def array(self, shard, key):
+        if (shard, key) not in self.arrays:
+            self.arrays[(shard, key)] = np.load(
+                os.path.join(self.path, '{}.{}.npy'.format(self.shards[shard], key)),
+                mmap_mode='r')
+        return self.arrays[(shard, key)]
+
+    def length(self, j, key):
+        return self.utterances[j][key][1]
+
+    def get(self, j, key, start=0, stop=None):
+        """Rows [start, stop) of key of utterance j, a read-only view"""
+        utterance = self.utterances[j]
+        offset, length = utterance[key]
+        stop = length if stop is None else min(stop, length)
+        return self.array(utterance['shard'], key)[offset + start:offset + stop]
+
+
+class FeatureStore(torch.utils.data.Dataset):
+    """
+    Mel2Samp over a store written by build: returns the same (mel, audio)
+    pairs, a random segment_length of pre-emphasized audio in [-1, 1] and
+    its mel frames, sliced straight out of the memory-mapped shards.
+    Segments start on a hop boundary so that the frames of the whole
+    utterance line up with them, and are drawn from the voiced ranges of
+    the index when it was built with the same segment_length.  audio_only
+    returns just the audio, for mels computed in the training step.
+    """
+    def __init__(self, store_path, segment_length, hop_length, sampling_rate,
+                 audio_only=False):
+        self.store = ShardReader(store_path)
+        for key, value in (('hop_length', hop_length),
+                           ('sampling_rate', sampling_rate)):
+            if self.store.config.get(key) != value:
+                raise Exception("{} of {} is {}, data_config has {}".format(
+                    key, store_path, self.store.config.get(key), value))
+        if segment_length % hop_length:
+            raise Exception("segment_length must be a multiple of hop_length")
+        self.segment_length = segment_length
+        self.hop_length = hop_length
+        self.audio_only = audio_only
+        self.utterances = [j for j in range(len(self.store))
+                           if self.store.length(j, 'audio') >= segment_length]
+        self.voiced = None
+        if self.store.config.get('segment_length') == segment_length:
+            self.voiced = {}
+            for j, utterance in enumerate(self.store.utterances):
+                if utterance['voiced']:
+                    self.voiced[j] = (utterance['voiced'],
+                                      run_counts(utterance['voiced']))
+            self.utterances = [j for j in self.utterances if j in self.voiced]
+        random.seed(1234)
+        random.shuffle(self.utterances)
+
+    def __getitem__(self, index):
+        j = self.utterances[index]
+        n_frames = self.segment_length // self.hop_length
+        max_frame_start = (self.store.length(j, 'audio') - self.segment_length) \
+            // self.hop_length
+        if self.voiced is not None:
+            frame_start = sample_start(*self.voiced[j])
+            audio_start = frame_start * self.hop_length
+            audio = self.store.get(j, 'audio', audio_start,
+                                   audio_start + self.segment_length)
+        else:
+            # 和Mel2Samp的阈值一样，按int16幅度算
+            audio_std = 0
+            while audio_std < 1e-5:
+                frame_start = random.randint(0, max_frame_start)
+                audio_start = frame_start * self.hop_length
+                audio = self.store.get(j, 'audio', audio_start,
+                                       audio_start + self.segment_length)
+                audio_std = audio.std() * MAX_WAV_VALUE
+        if self.audio_only:
+            return torch.from_numpy(np.array(audio))
+        # 和Mel2Samp一样，segment_length个采样点对应n_frames+1帧
+        mel = self.store.get(j, 'mel', frame_start, frame_start + n_frames + 1)
+        return (torch.from_numpy(np.ascontiguousarray(mel.T)),
+                torch.from_numpy(np.array(audio)))
+
+    def __len__(self):
+        return len(self.utterances)
+
+
+_stft = None
+_hop_length = None
+_segment_length = None
+_with_audio = True
+
+
+def _init_build_worker(data_config, with_audio=True):
+    global _stft, _hop_length, _segment_length, _with_audio
+    _hop_length = data_config['hop_length']
+    _segment_length = data_config['segment_length']
+    _with_audio = with_audio
+    torch.set_num_threads(1)
+    _stft = TacotronSTFT(filter_length=data_config['filter_length'],
+                         hop_length=data_config['hop_length'],
+                         win_length=data_config['win_length'],
+                         sampling_rate=data_config['sampling_rate'],
+                         mel_fmin=data_config['mel_fmin'],
+                         mel_fmax=data_config['mel_fmax'])
+
+
+def _build_job(filepath):
+    audio, sampling_rate = load_wav_to_torch(filepath)
+    with torch.no_grad():
+        mel = _stft.mel_spectrogram((audio / MAX_WAV_VALUE).unsqueeze(0))
+    mel = mel.squeeze(0).t().contiguous().numpy()
+    #只存mel时音频和非静音片段都用不到，不算也不传回主进程
+    if not _with_audio:
+        return filepath, sampling_rate, None, mel, None
+    #hop对齐的非静音片段起点（以帧为单位）
+    voiced = voiced_ranges(audio.numpy(), _segment_length, _hop_length)
+    return (filepath, sampling_rate, (audio / MAX_WAV_VALUE).numpy(), mel,
+            voiced)
+
+
+def build(filelist_path, data_config, output_dir, num_workers=1,
+          shard_bytes=2**30, with_audio=True):
+    """
+    Writes the pre-emphasized audio (float32 in [-1, 1]) and the mel frames
+    (frames x n_mel_channels) of every wav of filelist_path into shards of
+    output_dir, num_workers processes computing the mels.  with_audio=False
+    only stores the mels, e.g. for inference.py.
+    """
+    config = {key: data_config[key] for key in MEL_CONFIG_KEYS}
+    if with_audio:
+        config['segment_length'] = data_config['segment_length']
+    writer = ShardWriter(output_dir, shard_bytes, config)
+    filepaths = files_to_list(filelist_path)
+    with multiprocessing.Pool(num_workers, initializer=_init_build_worker,
+                              initargs=(data_config, with_audio)) as pool:
+        for filepath, sampling_rate, audio, mel, voiced in pool.imap(
+                _build_job, filepaths, chunksize=4):
+            if sampling_rate != data_config['sampling_rate']:
+                raise ValueError("{} SR doesn't match target {} SR".format(
+                    sampling_rate, data_config['sampling_rate']))
+            if with_audio:
+                writer.add(filepath, {'voiced': voiced},
+                           audio=audio.astype(np.float32),
+                           mel=mel.astype(np.float32))
+            else:
+                writer.add(filepath, mel=mel.astype(np.float32))
+            print(filepath)
+    writer.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', "--filelist_path", required=True)
+    parser.add_argument('-c', '--config', type=str, required=True,
+                        help='JSON file for configuration')
+    parser.add_argument('-o', '--output_dir', type=str, required=True,
+                        help='directory of the shards and index.json')
+    parser.add_argument('--num_workers', default=1, type=int,
+                        help='processes computing mels')
+    parser.add_argument('--shard_mb', default=1024, type=int,
+                        help='approximate size of one shard')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        data_config = json.loads(f.read())["data_config"]
+    build(args.filelist_path, data_config, args.output_dir, args.num_workers,
+          args.shard_mb * 2**20)
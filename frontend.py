@@ -0,0 +1,129 @@
+"""
+STFT and mel spectrogram frontend with the same interface and values as
+tacotron2's layers.TacotronSTFT and stft.STFT, built on torch.stft/istft.
+Only needs numpy and torch.
+"""
+import functools
+import numpy as np
+import torch
+
+
+def hz_to_mel(frequencies):
+    """Slaney mel scale, linear below 1kHz and logarithmic above (librosa's default)"""
+    frequencies = np.asanyarray(frequencies, dtype=np.float64)
+    f_sp = 200.0 / 3
+    mels = frequencies / f_sp
+    min_log_hz = 1000.0
+    min_log_mel = min_log_hz / f_sp
+    logstep = np.log(6.4) / 27.0
+    log_t = frequencies >= min_log_hz
+    mels = np.where(log_t, min_log_mel + np.log(np.maximum(frequencies, min_log_hz)
+                                                / min_log_hz) / logstep, mels)
+    return mels
+
+
+def mel_to_hz(mels):
+    mels = np.asanyarray(mels, dtype=np.float64)
+    f_sp = 200.0 / 3
+    freqs = f_sp * mels
+    min_log_hz = 1000.0
+    min_log_mel = min_log_hz / f_sp
+    logstep = np.log(6.4) / 27.0
+    log_t = mels >= min_log_mel
+    return np.where(log_t, min_log_hz * np.exp(logstep * (mels - min_log_mel)), freqs)
+
+
+@functools.lru_cache(maxsize=None)
+def mel_filterbank(sampling_rate, n_fft, n_mels=80, fmin=0.0, fmax=None):
+    """
+    n_mels x (n_fft/2+1) triangular filters with Slaney area normalization,
+    the same matrix as librosa.filters.mel(sr, n_fft, n_mels, fmin, fmax).
+    Cached per configuration, do not modify the result in place.
+    """
+    if fmax is None:
+        fmax = sampling_rate / 2.0
+    fftfreqs = np.linspace(0, sampling_rate / 2.0, n_fft // 2 + 1)
+    mel_f = mel_to_hz(np.linspace(hz_to_mel(fmin), hz_to_mel(fmax), n_mels + 2))
+    fdiff = np.diff(mel_f)
+    ramps = np.subtract.outer(mel_f, fftfreqs)
+    lower = -ramps[:-2] / fdiff[:-1, None]
+    upper = ramps[2:] / fdiff[1:, None]
+    weights = np.maximum(0, np.minimum(lower, upper))
+    enorm = 2.0 / (mel_f[2:n_mels + 2] - mel_f[:n_mels])
+    return (weights * enorm[:, None]).astype(np.float32)
+
+
+@functools.lru_cache(maxsize=None)
+def hann_window(win_length):
+    """Periodic Hann window (scipy get_window('hann', fftbins=True)), cached"""
+    return torch.hann_window(win_length, periodic=True, dtype=torch.float32)
+
+
+def dynamic_range_compression(x, C=1, clip_val=1e-5):
+    return torch.log(torch.clamp(x, min=clip_val) * C)
+
+
+def dynamic_range_decompression(x, C=1):
+    return torch.exp(x) / C
+
+
+class STFT(torch.nn.Module):
+    """
+    transform gives (magnitude, phase) of batch x samples audio, both
+    batch x (filter_length/2+1) x frames with reflect padding of
+    filter_length/2 on both sides, and inverse turns them back into
+    batch x 1 x samples audio, like tacotron2's conv based STFT
+    """
+    def __init__(self, filter_length=800, hop_length=200, win_length=800,
+                 window='hann'):
+        super(STFT, self).__init__()
+        if window != 'hann':
+            raise Exception("Window {} is not supported".format(window))
+        assert(filter_length >= win_length)
+        self.filter_length = filter_length
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.register_buffer('window', hann_window(win_length).clone())
+
+    def transform(self, input_data):
+        spec = torch.stft(input_data, self.filter_length, self.hop_length,
+                          self.win_length, self.window, center=True,
+                          pad_mode='reflect', return_complex=True)
+        return spec.abs(), spec.angle()
+
+    def inverse(self, magnitude, phase):
+        audio = torch.istft(torch.polar(magnitude, phase), self.filter_length,
+                            self.hop_length, self.win_length, self.window,
+                            center=True)
+        return audio.unsqueeze(1)
+
+    def forward(self, input_data):
+        magnitude, phase = self.transform(input_data)
+        return self.inverse(magnitude, phase)
+
+
+class TacotronSTFT(torch.nn.Module):
+    def __init__(self, filter_length=1024, hop_length=256, win_length=1024,
+                 n_mel_channels=80, sampling_rate=22050, mel_fmin=0.0,
+                 mel_fmax=8000.0):
+        super(TacotronSTFT, self).__init__()
+        self.n_mel_channels = n_mel_channels
+        self.sampling_rate = sampling_rate
+        self.stft_fn = STFT(filter_length, hop_length, win_length)
+        mel_basis = mel_filterbank(sampling_rate, filter_length, n_mel_channels,
+                                   mel_fmin, mel_fmax)
+        self.register_buffer('mel_basis', torch.from_numpy(mel_basis.copy()))
+
+    def spectral_normalize(self, magnitudes):
+        return dynamic_range_compression(magnitudes)
+
+    def spectral_de_normalize(self, magnitudes):
+        return dynamic_range_decompression(magnitudes)
+
+    def mel_spectrogram(self, y):
+        """y: batch x samples in [-1, 1], returns batch x n_mel_channels x frames"""
+        assert(torch.min(y.data) >= -1)
+        assert(torch.max(y.data) <= 1)
+        magnitudes, _ = self.stft_fn.transform(y)
+        mel_output = torch.matmul(self.mel_basis, magnitudes)
+        return self.spectral_normalize(mel_output)
@@ -25,6 +25,11 @@
 #
 # *****************************************************************************
 import copy
+import json
+import time
+import resource
+import contextlib
+import collections
 import torch
 import numpy as np
 from torch.autograd import Variable
@@ -41,14 +46,196 @@ def fused_add_tanh_sigmoid_multiply(input_a, input_b, n_channels):
     return acts
 
 
+def current_rss():
+    """Resident set size of this process in bytes, from /proc/self/statm"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes (VmHWM)"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    raise Exception("VmHWM missing from /proc/self/status")
+
+
+def reset_peak_rss():
+    """Resets VmHWM to the current RSS (Linux 4.0+)"""
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+class Profiler(object):
+    """
+    Opt-in timing of the inference stages.  Assign an instance to
+    glow.profiler and every profile(name) block inside infer and the
+    Denoiser records its wall time and peak memory.  Stages are summed per
+    utterance between begin() and end().  The peak memory of a stage (and of
+    the whole utterance) is the CUDA allocator peak of device, 'peak_bytes',
+    or for a CPU device the peak RSS of the process, 'peak_rss_bytes' (see
+    memory_key), with the peak counter reset at the start of every stage.
+    Where the RSS peak cannot be reset (no Linux /proc) memory_key is None
+    and only times are recorded.
+    """
+    def __init__(self, device=None, sync=None):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        #GPU上异步执行，计时前后要同步
+        self.sync = self.cuda if sync is None else sync
+        self.memory_key = 'peak_bytes' if self.cuda else 'peak_rss_bytes'
+        if not self.cuda:
+            try:
+                reset_peak_rss()
+            except (IOError, OSError):
+                self.memory_key = None
+        self.utterances = []
+        self.stages = None
+        self.open = []
+
+    def peak(self):
+        if self.cuda:
+            return torch.cuda.max_memory_allocated(self.device)
+        return peak_rss()
+
+    def enter(self):
+        """Starts the peak memory measurement of a (possibly nested) stage"""
+        if self.memory_key is None:
+            return
+        #重置峰值前先把它记到外层的stage里
+        peak = self.peak()
+        self.open = [max(outer, peak) for outer in self.open]
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.open.append(torch.cuda.memory_allocated(self.device))
+        else:
+            reset_peak_rss()
+            self.open.append(current_rss())
+
+    def exit(self):
+        """Peak memory of the innermost open stage"""
+        if self.memory_key is None:
+            return None
+        peak = max(self.open.pop(), self.peak())
+        self.open = [max(outer, peak) for outer in self.open]
+        return peak
+
+    @contextlib.contextmanager
+    def record(self, name):
+        if self.stages is None:
+            yield
+            return
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        self.enter()
+        st = time.time()
+        yield
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        seconds = time.time() - st
+        peak = self.exit()
+        stage = self.stages[name]
+        stage['seconds'] += seconds
+        if self.memory_key is not None:
+            stage[self.memory_key] = max(stage[self.memory_key], peak)
+
+    def begin(self):
+        self.stages = collections.defaultdict(
+            lambda: {'seconds': 0.0} if self.memory_key is None else
+            {'seconds': 0.0, self.memory_key: 0})
+        self.open = []
+        self.enter()
+        self.start = time.time()
+
+    def end(self, name, n_samples, sampling_rate):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        wall = time.time() - self.start
+        audio_seconds = n_samples / float(sampling_rate)
+        utterance = {'name': name,
+                     'audio_seconds': audio_seconds,
+                     'seconds': wall,
+                     'rtf': wall / audio_seconds if audio_seconds > 0 else 0.0,
+                     'stages': dict(self.stages)}
+        peak = self.exit()
+        if self.memory_key is not None:
+            utterance[self.memory_key] = peak
+        self.utterances.append(utterance)
+        self.stages = None
+
+    def summary(self):
+        """
+        Seconds per stage summed over all utterances, the overall RTF and the
+        largest memory_key value of any utterance and of every stage
+        """
+        key = self.memory_key
+        stages = {}
+        for utterance in self.utterances:
+            for name, stage in utterance['stages'].items():
+                total = stages.setdefault(name, dict(stage, seconds=0.0))
+                total['seconds'] += stage['seconds']
+                if key is not None:
+                    total[key] = max(total[key], stage[key])
+        seconds = sum(u['seconds'] for u in self.utterances)
+        audio_seconds = sum(u['audio_seconds'] for u in self.utterances)
+        summary = {'utterances': len(self.utterances),
+                   'seconds': seconds,
+                   'audio_seconds': audio_seconds,
+                   'rtf': seconds / audio_seconds if audio_seconds > 0 else 0.0,
+                   'stages': stages}
+        if key is not None:
+            summary[key] = max([u[key] for u in self.utterances] or [0])
+        return summary
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(), 'utterances': self.utterances},
+                      f, indent=4)
+
+    def log(self, logger, tag='profile'):
+        """Writes every utterance to a tensorboardX SummaryWriter, step = index"""
+        key = self.memory_key
+        memory_tag = '/peak_mb' if self.cuda else '/peak_rss_mb'
+        for i, utterance in enumerate(self.utterances):
+            logger.add_scalar(tag + '/rtf', utterance['rtf'], i)
+            if key is not None:
+                logger.add_scalar(tag + memory_tag, utterance[key] / 2**20, i)
+            for name, stage in utterance['stages'].items():
+                logger.add_scalar(tag + '/' + name, stage['seconds'], i)
+                if key is not None:
+                    logger.add_scalar(tag + '/' + name + memory_tag,
+                                      stage[key] / 2**20, i)
+
+
+profiler = None
+_no_profile = contextlib.nullcontext()
+
+
+def profile(name):
+    """Times the enclosed block as stage name when a profiler is set"""
+    if profiler is None:
+        return _no_profile
+    return profiler.record(name)
+
+
 class WaveGlowLoss(torch.nn.Module):
     def __init__(self, sigma=1.0):
         super(WaveGlowLoss, self).__init__()
         self.sigma = sigma
 
     def forward(self, model_output):
-        z,log_s1_list, log_s2_list ,log_det_W_list= model_output
+        z,log_s1_list, log_s2_list ,log_det_W_list= model_output[:4]
+        #变长batch时WaveGlow还会输出padding的mask（batch x 1 x time），只算有效部分
+        mask = model_output[4].float() if len(model_output) > 4 else None
+        #混合精度训练时输出可能是fp16，loss统一用fp32算
+        z = z.float()
+        if mask is not None:
+            z = z * mask
         for i, log_s in enumerate(zip(log_s1_list,log_s2_list)):
+            log_s = [l.float() if mask is None else l.float() * mask for l in log_s]
             if i == 0:
                 log_s_total = torch.sum(log_s[0])+torch.sum(log_s[1])
                 log_det_W_total = log_det_W_list[i]
@@ -56,10 +243,15 @@ class WaveGlowLoss(torch.nn.Module):
                 log_s_total = log_s_total + torch.sum(log_s[0])+torch.sum(log_s[1])
                 log_det_W_total += log_det_W_list[i]
 
+        n_positions = z.size(0)*z.size(2)
+        if mask is not None:
+            #log|det W|是按batch*time个位置算的，换成有效位置数
+            log_det_W_total = log_det_W_total * (mask.sum() / n_positions)
+            n_positions = mask.sum()
         loss = torch.sum(z*z)/(2*self.sigma*self.sigma) - log_s_total - log_det_W_total
         if not loss <0:
             print("no")
-        return loss/(z.size(0)*z.size(1)*z.size(2))
+        return loss/(n_positions*z.size(1))
 
 
 class Invertible1x1Conv(torch.nn.Module):
@@ -83,25 +275,39 @@ class Invertible1x1Conv(torch.nn.Module):
         W = W.view(c, c, 1)
         self.conv.weight.data = W
 
+    def inverse_weight(self, dtype=None):
+        """
+        W^-1 as a c x c x 1 buffer.  Computed in fp32 and kept until the
+        weight is modified in place or replaced, then recomputed on the next
+        call.
+        """
+        weight = self.conv.weight
+        if dtype is None:
+            dtype = weight.dtype
+        key = (weight.data_ptr(), weight._version, weight.device, dtype)
+        if getattr(self, 'W_inverse_key', None) != key:
+            with torch.no_grad():
+                W_inverse = weight.squeeze().float().inverse()[..., None].to(dtype)
+            # 旧模型里W_inverse可能是普通属性，换成buffer跟着.to()/.half()走
+            if 'W_inverse' not in self._buffers and hasattr(self, 'W_inverse'):
+                del self.W_inverse
+            self.register_buffer('W_inverse', W_inverse, persistent=False)
+            self.W_inverse_key = key
+        return self.W_inverse
+
     def forward(self, z, reverse=False):
         # shape
         batch_size, group_size, n_of_groups = z.size()
 
-        W = self.conv.weight.squeeze()
-
         if reverse:
-            if not hasattr(self, 'W_inverse'):
-                # Reverse computation
-                W_inverse = W.float().inverse()
-                W_inverse = Variable(W_inverse[..., None])
-                if z.type() == 'torch.cuda.HalfTensor':
-                    W_inverse = W_inverse.half()
-                self.W_inverse = W_inverse
-            z = F.conv1d(z, self.W_inverse, bias=None, stride=1, padding=0)
-            return z
+            # Reverse computation, never in reduced precision under autocast
+            with torch.autocast(z.device.type, enabled=False):
+                return F.conv1d(z, self.inverse_weight(z.dtype), bias=None,
+                                stride=1, padding=0)
         else:
+            W = self.conv.weight.squeeze()
             # Forward computation
-            log_det_W = batch_size * n_of_groups * torch.det(W).abs().log()
+            log_det_W = batch_size * n_of_groups * torch.det(W.float()).abs().log()
             z = self.conv(z)
             return z, log_det_W
 
@@ -162,21 +368,36 @@ class WN(torch.nn.Module):
 
     def forward(self, forward_input):
         audio, spect = forward_input
+        return self.forward_cond(audio, self.cond_layer(spect))
+
+    def forward_cond(self, audio, spect, mask=None):
+        """
+        Same as forward, but spect has already been projected by cond_layer
+        (see WaveGlow.cond_projection).  mask (batch x 1 x time) zeroes the
+        hidden states and activations at padded positions, so that the
+        dilated convolutions see the same zeros there as past the end of an
+        unpadded input.
+        """
         audio = self.start(audio)
+        if mask is not None:
+            mask = mask.to(audio.dtype)
+            audio = audio * mask
         output = torch.zeros_like(audio)
         n_channels_tensor = torch.IntTensor([self.n_channels])
 
-        spect = self.cond_layer(spect)
-
         for i in range(self.n_layers):
             spect_offset = i*2*self.n_channels
             acts = fused_add_tanh_sigmoid_multiply(
                 self.in_layers[i](audio),
                 spect[:,spect_offset:spect_offset+2*self.n_channels,:],
                 n_channels_tensor)
+            if mask is not None:
+                acts = acts * mask
             res_skip_acts = self.res_skip_layers[i](acts)
             if i < self.n_layers - 1:
                 audio = audio + res_skip_acts[:,:self.n_channels,:]
+                if mask is not None:
+                    audio = audio * mask
                 output = output + res_skip_acts[:,self.n_channels:,:]
             else:
                 output = output + res_skip_acts
@@ -184,6 +405,105 @@ class WN(torch.nn.Module):
         return self.end(output)
 
 
+def _conv_weight(conv):
+    """
+    Current weight of a conv layer.  Layers that still carry weight norm only
+    refresh .weight in their forward pre-hook, so recompute it from g and v.
+    """
+    if hasattr(conv, 'weight_g'):
+        return torch._weight_norm(conv.weight_v, conv.weight_g, 0)
+    return conv.weight
+
+
+def fusable_wn(wns):
+    """
+    True if the convolutions of these WN modules are plain Conv1d layers whose
+    weights can be stacked (not e.g. quantized)
+    """
+    return all(isinstance(conv, torch.nn.Conv1d)
+               for wn in wns
+               for conv in [wn.cond_layer] + list(wn.in_layers) + list(wn.res_skip_layers))
+
+
+def grouped_wn(wns, audios, layer_cond):
+    """
+    Runs several WN modules that share n_layers, n_channels and kernel_size as
+    a single stack of grouped convolutions, module g being group g.  audios[g]
+    is the input of wns[g] and layer_cond(i) the already projected
+    conditioning of layer i of all modules, batch x n_wn*2*n_channels x
+    groups, so that only one layer of it exists at a time.  Returns the list
+    of per-module outputs.
+    """
+    n_wn = len(wns)
+    n_layers = wns[0].n_layers
+    n_channels = wns[0].n_channels
+    batch_size, n_groups = audios[0].size(0), audios[0].size(2)
+
+    audio = torch.cat([wn.start(a) for wn, a in zip(wns, audios)], 1)
+    output = torch.zeros_like(audio)
+
+    for i in range(n_layers):
+        cond = layer_cond(i)
+
+        in_layer = wns[0].in_layers[i]
+        in_act = F.conv1d(audio,
+                          torch.cat([_conv_weight(wn.in_layers[i]) for wn in wns], 0),
+                          torch.cat([wn.in_layers[i].bias for wn in wns], 0),
+                          dilation=in_layer.dilation, padding=in_layer.padding,
+                          groups=n_wn)
+        in_act = (in_act + cond).view(batch_size, n_wn, 2*n_channels, n_groups)
+        acts = torch.tanh(in_act[:, :, :n_channels, :]) * \
+            torch.sigmoid(in_act[:, :, n_channels:, :])
+        acts = acts.reshape(batch_size, n_wn*n_channels, n_groups)
+
+        res_skip_acts = F.conv1d(
+            acts,
+            torch.cat([_conv_weight(wn.res_skip_layers[i]) for wn in wns], 0),
+            torch.cat([wn.res_skip_layers[i].bias for wn in wns], 0),
+            groups=n_wn)
+        if i < n_layers - 1:
+            res_skip_acts = res_skip_acts.view(batch_size, n_wn, 2*n_channels, n_groups)
+            audio = audio + res_skip_acts[:, :, :n_channels, :].reshape(
+                batch_size, n_wn*n_channels, n_groups)
+            output = output + res_skip_acts[:, :, n_channels:, :].reshape(
+                batch_size, n_wn*n_channels, n_groups)
+        else:
+            output = output + res_skip_acts
+
+    output = output.view(batch_size, n_wn, n_channels, n_groups)
+    return [wn.end(output[:, g]) for g, wn in enumerate(wns)]
+
+
+class InferenceWorkspace(object):
+    """
+    Buffers reused by WaveGlow.infer across flows and calls.  Each named
+    buffer is one flat tensor that only grows, get() returns a contiguous
+    view of the requested shape at its start, so after the largest batch has
+    been seen no further buffers are allocated.
+    """
+    def __init__(self):
+        self.arenas = {}
+
+    def get(self, name, shape, like, zero=False):
+        """
+        Buffer name as a tensor of shape with the dtype and device of like.
+        The contents are left over from the previous use unless zero, in
+        which case the buffer is zeroed once when allocated and must never
+        be written to.
+        """
+        numel = int(np.prod(shape))
+        flat = self.arenas.get(name)
+        if (flat is None or flat.numel() < numel or flat.dtype != like.dtype
+                or flat.device != like.device):
+            flat = like.new_zeros(numel) if zero else like.new_empty(numel)
+            self.arenas[name] = flat
+        return flat[:numel].view(shape)
+
+    def nbytes(self):
+        return sum(flat.numel() * flat.element_size()
+                   for flat in self.arenas.values())
+
+
 class WaveGlow(torch.nn.Module):
     def __init__(self, n_mel_channels, n_flows, n_group, n_early_every,
                  n_early_size, WN_config):
@@ -224,24 +544,28 @@ class WaveGlow(torch.nn.Module):
         """
         forward_input[0] = mel_spectrogram:  batch x n_mel_channels x frames
         forward_input[1] = audio: batch x time
+        forward_input[2] = lengths (optional): batch, samples of every padded
+        item.  The padding is kept at zero through the flows and its mask is
+        returned as a fifth output for WaveGlowLoss.
         """
         #6*80*63，6*16000
-        spect, audio = forward_input
+        spect, audio = forward_input[:2]
+        lengths = forward_input[2] if len(forward_input) > 2 else None
 
         #  Upsample spectrogram to size of audio
-        # 上采样，扩大音频
-        spect = self.upsample(spect)
-        #6*80*16896
+        # 上采样，扩大音频，同时完成squeeze：16000个采样点8个为一组，保持局部相关性
+        spect = self.upsample_groups(spect)
+        #6*640*2112
         #音频和mel谱对齐
-        assert(spect.size(2) >= audio.size(1))
-        if spect.size(2) > audio.size(1):
-            spect = spect[:, :, :audio.size(1)]
-        #6*80*16000，对应squeeze操作，16000个采样点8个为一组，保持局部相关性
-        spect = spect.unfold(2, self.n_group, self.n_group).permute(0, 2, 1, 3)#6*2000*80*8
-        #一组mel谱集合起来
-        spect = spect.contiguous().view(spect.size(0), spect.size(1), -1).permute(0, 2, 1)#6*640*2000
+        assert(spect.size(2)*self.n_group >= audio.size(1))
+        spect = spect[:, :, :audio.size(1) // self.n_group]#6*640*2000
         #squeeze操作，同上
         audio = audio.unfold(1, self.n_group, self.n_group).permute(0, 2, 1)#6*8*2000
+        mask = None
+        if lengths is not None:
+            steps = torch.arange(audio.size(2), device=audio.device)
+            mask = (steps[None, :] < (lengths.to(audio.device) // self.n_group)[:, None])
+            mask = mask.unsqueeze(1).to(audio.dtype)
         output_audio = []
         #log_s_list = []
         log_s1_list = []
@@ -264,25 +588,22 @@ class WaveGlow(torch.nn.Module):
             audio_1 = audio[:,n_half:,:]
             #(logs,t)=WN(x_a,mel),output=[batch_size,8,2000]
             #output = self.WN[k]((audio_0, spect))      
-            if spect.type() == 'torch.cuda.HalfTensor':
-                # input_0 = torch.from_numpy(np.ones(audio_0.size())/MAX_WAV_VALUE).float().cuda().half()
-                input_0 = torch.from_numpy(np.zeros(audio_0.size())/MAX_WAV_VALUE).float().cuda().half()
-                input_0 = torch.cuda.HalfTensor(input_0)
-                input_0 = torch.autograd.Variable(input_0)
-                # input_0 = torch.cuda.HalfTensor(audio_0.size()).normal_()/MAX_WAV_VALUE
-            else:
-                # input_0 = torch.from_numpy(np.ones(audio_0.size()) / MAX_WAV_VALUE).float().cuda()
-                input_0 = torch.from_numpy(np.zeros(audio_0.size()) / MAX_WAV_VALUE).float().cuda()
-                input_0 = torch.autograd.Variable(input_0)
-                # input_0 = torch.cuda.FloatTensor(audio_0.size()).normal_()/MAX_WAV_VALUE
-            output1 = self.WN1[k]((input_0, spect))
+            #WN1[k]和WN2[k]的cond_layer合并成一次1*1卷积
+            wn1_cond, wn2_cond = self.cond_projection(spect, k)
+            # WN1 sees an all-zero input, created on the device/dtype of spect
+            input_0 = torch.zeros_like(audio_0)
+            output1 = self.WN1[k].forward_cond(input_0, wn1_cond, mask)
             log_s1 = output1[:, n_half:, :]
             t_1 = output1[:, :n_half, :]
-            y_1 =  torch.exp(log_s1)*audio_0+t_1
-            output2 = self.WN2[k](((y_1+audio_0), spect))
+            y_1 =  torch.exp(log_s1.float())*audio_0+t_1
+            #padding处y_1等于t_1，不为0，WN2的输入也要mask
+            input_2 = y_1+audio_0
+            if mask is not None:
+                input_2 = input_2 * mask
+            output2 = self.WN2[k].forward_cond(input_2, wn2_cond, mask)
             log_s2 = output2[:, n_half:, :]
             t_2 = output2[:, :n_half, :]
-            y_2 = torch.exp(log_s2)*audio_1+t_2
+            y_2 = torch.exp(log_s2.float())*audio_1+t_2
             #y_1 = 
             #log_s2 = self.WN2[k]((y_1, spect))
             #y_2 = torch.exp(log_s2)*audio_1+self.WN4[k](y_1,spect)
@@ -298,115 +619,409 @@ class WaveGlow(torch.nn.Module):
             #concat(x_a,x_b')
             #audio = torch.cat([audio_0, audio_1],1)
             audio = torch.cat([y_1,y_2],1)
+            if mask is not None:
+                audio = audio * mask
 
         output_audio.append(audio)
+        if mask is not None:
+            return (torch.cat(output_audio,1), log_s1_list, log_s2_list,
+                    log_det_W_list, mask)
         return torch.cat(output_audio,1),  log_s1_list, log_s2_list, log_det_W_list
 
-    def infer(self, spect, sigma=1.0):
-        #一维反卷积
-        #1*80*375
-        spect = self.upsample(spect)
-        #1*80*96768
-        # trim conv artifacts. maybe pad spec to kernel multiple
-        time_cutoff = self.upsample.kernel_size[0] - self.upsample.stride[0]
-        spect = spect[:, :, :-time_cutoff]
-        #1*80*96000
-        #unfold滑动窗口，permute换维
-        spect = spect.unfold(2, self.n_group, self.n_group).permute(0, 2, 1, 3)
-        #1*12000*80*8
-        spect = spect.contiguous().view(spect.size(0), spect.size(1), -1).permute(0, 2, 1)
-        #1*640*12000，True
-        # y_0 = torch.from_numpy(np.ones([spect.size(0),
-        #                                   int(self.n_remaining_channels/2),
-        #                                   spect.size(2)])).cuda()/MAX_WAV_VALUE
-        y_0 = torch.from_numpy(np.zeros([spect.size(0),
-                                          int(self.n_remaining_channels/2),
-                                          spect.size(2)])).cuda()/MAX_WAV_VALUE
-        if spect.type() == 'torch.cuda.HalfTensor':
-            audio = torch.cuda.HalfTensor(spect.size(0),
-                                          self.n_remaining_channels,
-                                          spect.size(2)).normal_()
-            y_0 =y_0.half()
-            y_0 = torch.cuda.HalfTensor(y_0)
-            y_0 = torch.autograd.Variable(sigma * y_0)
-            # y_0 = torch.cuda.HalfTensor(spect.size(0),
-            #                               int(self.n_remaining_channels/2),
-            #                               spect.size(2)).normal_()/MAX_WAV_VALUE
-            # y_0 = sigma * y_0
-            #1*4*12000
-        else:
-            audio = torch.cuda.FloatTensor(spect.size(0),
-                                           self.n_remaining_channels,
-                                           spect.size(2)).normal_()
-            y_0 =y_0.float()
-            y_0 = torch.autograd.Variable(sigma * y_0)
-            # y_0 = torch.cuda.FloatTensor(spect.size(0),
-            #                               int(self.n_remaining_channels/2),
-            #                               spect.size(2)).normal_()/MAX_WAV_VALUE
-            # y_0 = sigma * y_0
+    def upsample_groups(self, spect, cache=False):
+        """
+        self.upsample followed by the squeeze into groups of n_group samples,
+        as one transposed convolution: channel o*n_group+g at step n is
+        sample n*n_group+g of upsampled channel o.  The full-rate
+        n_mel_channels x samples tensor is never built.  Returns batch x
+        n_mel_channels*n_group x (untrimmed samples / n_group).  cache is
+        passed on to grouped_upsample_weight.
+        """
+        weight, bias = self.grouped_upsample_weight(cache)
+        return F.conv_transpose1d(spect, weight, bias,
+                                  stride=self.upsample.stride[0] // self.n_group)
+
+    def grouped_upsample_weight(self, cache=False):
+        """
+        The upsample weight (in, out, kernel) rearranged to (in, out*n_group,
+        kernel/n_group) and its bias repeated n_group times.  With cache (as
+        infer does) it is kept until the upsample parameters change, if
+        keep_weights allows.
+        """
+        n_in, n_out, kernel_size = self.upsample.weight.size()
+        stride = self.upsample.stride[0]
+        if kernel_size % self.n_group or stride % self.n_group:
+            raise Exception("n_group {} must divide the upsample kernel {} and "
+                            "stride {}".format(self.n_group, kernel_size, stride))
+        key = tuple((p.data_ptr(), p._version, p.dtype)
+                    for p in (self.upsample.weight, self.upsample.bias))
+        cache = cache and self.keep_weights()
+        if not cache or getattr(self, 'upsample_weight_key', None) != key:
+            # W'[i, o*n_group+g, m] = W[i, o, m*n_group+g]
+            weight = self.upsample.weight.view(
+                n_in, n_out, kernel_size // self.n_group, self.n_group).permute(
+                    0, 1, 3, 2).reshape(n_in, n_out*self.n_group,
+                                        kernel_size // self.n_group)
+            bias = self.upsample.bias.repeat_interleave(self.n_group)
+            if not cache:
+                return weight, bias
+            self.upsample_weight, self.upsample_bias = weight, bias
+            self.upsample_weight_key = key
+        return self.upsample_weight, self.upsample_bias
+
+    def receptive_field(self):
+        """
+        Number of mel frames on each side of a frame that can influence its
+        audio in infer: the upsample kernel overlap plus, for every flow, the
+        dilated in_layers of one WN (WN2 feeds the audio of the next flow).
+        """
+        wn = self.WN2[0]
+        kernel_size = wn.in_layers[0].kernel_size[0]
+        wn_field = sum(int((kernel_size-1)/2) * layer.dilation[0]
+                       for layer in wn.in_layers)
+        hop_length = self.upsample.stride[0]
+        upsample_frames = int(np.ceil(self.upsample.kernel_size[0] / float(hop_length)))
+        flow_frames = int(np.ceil(self.n_flows * wn_field * self.n_group / float(hop_length)))
+        return upsample_frames + flow_frames
+
+    def infer(self, spect, sigma=1.0, z=None, workspace=None):
+        """
+        z optionally gives the unit normal noise to use: batch x n_group x
+        (frames*hop_length/n_group).  Its first n_remaining_channels channels
+        start the reverse flow and the following n_early_size channels are
+        consumed at each early-output boundary.  Drawn here when None.
+        With an InferenceWorkspace the intermediate tensors live in its
+        buffers, see infer_workspace.  Runs under torch.autocast when
+        set_precision chose a reduced precision.
+        """
+        if getattr(self, 'autocast_dtype', None) is not None:
+            with torch.autocast(spect.device.type, dtype=self.autocast_dtype):
+                return self.infer_flows(spect, sigma, z, workspace)
+        return self.infer_flows(spect, sigma, z, workspace)
+
+    def set_precision(self, dtype=None):
+        """
+        dtype (torch.float16 or torch.bfloat16) makes infer run under
+        torch.autocast, None back to full precision.  The audio, exp(log_s)
+        and the 1x1 inverses are kept in fp32 either way.
+        """
+        self.autocast_dtype = dtype
+        return self
+
+    def infer_flows(self, spect, sigma=1.0, z=None, workspace=None):
+        if workspace is not None:
+            return self.infer_workspace(spect, sigma, z, workspace)
+        #音频和噪声的精度跟随模型参数，autocast下仍是fp32
+        audio_dtype = self.upsample.weight.dtype
+        with profile('upsample'):
+            #一维反卷积，直接输出squeeze后的排列
+            #1*80*375
+            #反卷积核长1024，CPU上bf16比fp32慢得多，不走autocast
+            with torch.autocast(spect.device.type, enabled=False):
+                spect = self.upsample_groups(spect, cache=True)
+            #1*640*12096
+            # trim conv artifacts. maybe pad spec to kernel multiple
+            time_cutoff = (self.upsample.kernel_size[0] - self.upsample.stride[0]) // self.n_group
+            spect = spect[:, :, :-time_cutoff]
+        #1*640*12000
+        #WN1的输入恒为0，输出只和mel有关，CUDA上在逆向循环之前一次算完
+        wn1_outputs = None
+        if self.group_wn1(spect):
+            with profile('WN1'):
+                wn1_outputs = self.infer_wn1_grouped(spect)
+        #1*8*12000，噪声跟随spect所在的设备和精度
+        if z is None:
+            # same draw order as sampling each early output when it is needed
+            n_early_outputs = len([k for k in range(1, self.n_flows)
+                                   if k % self.n_early_every == 0])
+            z = torch.cat(
+                [spect.new_empty((spect.size(0), self.n_remaining_channels,
+                                  spect.size(2)), dtype=audio_dtype).normal_()] +
+                [spect.new_empty((spect.size(0), self.n_early_size,
+                                  spect.size(2)), dtype=audio_dtype).normal_()
+                 for _ in range(n_early_outputs)], 1)
+        z_offset = self.n_remaining_channels
+        audio = z[:, :z_offset, :]
         #封装数据
         audio = torch.autograd.Variable(sigma*audio)
 
         for k in reversed(range(self.n_flows)):
-            n_half = int(audio.size(1)/2)
-            # 1*2*12000
-            audio_0 = audio[:,:n_half,:]
-            audio_1 = audio[:,n_half:,:]
-            #1*4*12000
-            #output = self.WN[k]((audio_0, spect))
-            output1 = self.WN1[k]((y_0, spect))
-            log_s1 = output1[:, n_half:, :]
-            t_1 = output1[:, :n_half, :]
-            y_1 = audio_0
-            x_a = (y_1-t_1)/torch.exp(log_s1)
-            
-            output2 = self.WN2[k](((y_1+audio_0)/2, spect))
-            log_s2 = output2[:, n_half:, :]
-            t_2 = output2[:, :n_half, :]
-            y_2 = audio_1
-            x_b = (y_2-t_2)/torch.exp(log_s2)
-            #1*2*12000
-            #s = output[:, n_half:, :]
-            #b = output[:, :n_half, :]
-            #1*2*12000,(y_b-t)/s
-            #audio_1 = (audio_1 - b)/torch.exp(s)
-            #1*4*12000
-            audio = torch.cat([x_a, x_b],1)
-            #1*1卷积，4*4
-            audio = self.convinv[k](audio, reverse=True)
-            #1*4*12000,每经过四个flows就加入两个channel
-            if k % self.n_early_every == 0 and k > 0:
-                # y_0 = torch.from_numpy(np.ones([spect.size(0),
-                #                                 int((audio.size()[1]+self.n_early_size) / 2),
-                #                                 spect.size(2)])).cuda() / MAX_WAV_VALUE
-                y_0 = torch.from_numpy(np.zeros([spect.size(0),
-                                          int((audio.size()[1]+self.n_early_size) / 2),
-                                          spect.size(2)])).cuda()/MAX_WAV_VALUE
-                if spect.type() == 'torch.cuda.HalfTensor':
-                    z = torch.cuda.HalfTensor(spect.size(0), self.n_early_size, spect.size(2)).normal_()
-                    y_0 = y_0.half()
-                    y_0 = torch.cuda.HalfTensor(y_0)
-                    y_0 = torch.autograd.Variable(sigma*y_0)
-                    # y_0 = torch.cuda.HalfTensor(spect.size(0),
-                    #                             int((audio.size()[1]+self.n_early_size) / 2),
-                    #                             spect.size(2)).normal_()/MAX_WAV_VALUE
-                    # y_0 = sigma * y_0
+            with profile('flow.%d' % k):
+                n_half = int(audio.size(1)/2)
+                # 1*2*12000
+                audio_0 = audio[:,:n_half,:]
+                audio_1 = audio[:,n_half:,:]
+                #1*4*12000
+                #output = self.WN[k]((audio_0, spect))
+                if wn1_outputs is None:
+                    with profile('WN1.%d' % k):
+                        t_1, log_s1 = self.infer_wn1(spect, k)
                 else:
-                    z = torch.cuda.FloatTensor(spect.size(0), self.n_early_size, spect.size(2)).normal_()
-                    y_0 = y_0.float()
-                    y_0 = torch.autograd.Variable(sigma*y_0)
-                    # y_0 = torch.cuda.FloatTensor(spect.size(0),
-                    #                             int((audio.size()[1]+self.n_early_size) / 2),
-                    #                             spect.size(2)).normal_()/MAX_WAV_VALUE
-                    # y_0 = sigma * y_0
-                audio = torch.cat((sigma*z, audio),1)
-                #k=8,1*6*12000，k=4,1*8*12000
+                    t_1, log_s1 = wn1_outputs[k]
+                y_1 = audio_0
+                x_a = ((y_1-t_1)/torch.exp(log_s1.float())).to(audio.dtype)
+
+                with profile('WN2.%d' % k):
+                    wn2_cond, = self.cond_projection(spect, k, ('WN2',), cache=True)
+                    output2 = self.WN2[k].forward_cond((y_1+audio_0)/2, wn2_cond)
+                log_s2 = output2[:, n_half:, :]
+                t_2 = output2[:, :n_half, :]
+                y_2 = audio_1
+                x_b = ((y_2-t_2)/torch.exp(log_s2.float())).to(audio.dtype)
+                #1*2*12000
+                #s = output[:, n_half:, :]
+                #b = output[:, :n_half, :]
+                #1*2*12000,(y_b-t)/s
+                #audio_1 = (audio_1 - b)/torch.exp(s)
+                #1*4*12000
+                audio = torch.cat([x_a, x_b],1)
+                #1*1卷积，4*4
+                with profile('convinv.%d' % k):
+                    audio = self.convinv[k](audio, reverse=True)
+                #1*4*12000,每经过四个flows就加入两个channel
+                if k % self.n_early_every == 0 and k > 0:
+                    z_early = z[:, z_offset:z_offset+self.n_early_size, :]
+                    z_offset += self.n_early_size
+                    audio = torch.cat((sigma*z_early, audio),1)
+                    #k=8,1*6*12000，k=4,1*8*12000
         #1*8*12000
-        audio = audio.permute(0,2,1).contiguous().view(audio.size(0), -1).data
+        audio = audio.permute(0,2,1).contiguous().view(audio.size(0), -1).detach()
         #1*96000
         
         return audio
 
+    def infer_workspace(self, spect, sigma, z, workspace):
+        """
+        infer on workspace buffers: the audio of all flows is one batch x
+        n_group x groups buffer whose trailing channels are the current
+        audio, early outputs are written in front of it instead of
+        concatenated, the coupling is updated in place and the 1x1 inverse
+        writes straight back into it.  Only the returned audio and the
+        convolution outputs are allocated per call.
+        """
+        batch_size = spect.size(0)
+        with profile('upsample'):
+            with torch.autocast(spect.device.type, enabled=False):
+                spect = self.upsample_groups(spect, cache=True)
+            time_cutoff = (self.upsample.kernel_size[0] - self.upsample.stride[0]) // self.n_group
+            n_groups = spect.size(2) - time_cutoff
+            spect = spect[:, :, :n_groups]
+        wn1_outputs = None
+        if self.group_wn1(spect):
+            with profile('WN1'):
+                wn1_outputs = self.infer_wn1_grouped(spect, workspace)
+        # audio buffers in the precision of the parameters, not of autocast
+        audio_like = spect.new_empty((0,), dtype=self.upsample.weight.dtype)
+
+        n_early_outputs = len([k for k in range(1, self.n_flows)
+                               if k % self.n_early_every == 0])
+        if z is None:
+            #每段噪声单独一块连续buffer，抽样顺序和结果与infer相同
+            z_remaining = workspace.get('z', (batch_size, self.n_remaining_channels,
+                                              n_groups), audio_like).normal_()
+            z_early = [workspace.get('z_early%d' % i, (batch_size, self.n_early_size,
+                                                       n_groups), audio_like).normal_()
+                       for i in range(n_early_outputs)]
+        else:
+            z_remaining = z[:, :self.n_remaining_channels]
+            z_early = [z[:, self.n_remaining_channels + i*self.n_early_size:
+                         self.n_remaining_channels + (i+1)*self.n_early_size]
+                       for i in range(n_early_outputs)]
+
+        audio_buffer = workspace.get('audio', (batch_size, self.n_group, n_groups),
+                                     audio_like)
+        offset = self.n_group - self.n_remaining_channels
+        torch.mul(z_remaining, sigma, out=audio_buffer[:, offset:])
+        n_early = 0
+        for k in reversed(range(self.n_flows)):
+            with profile('flow.%d' % k):
+                audio = audio_buffer[:, offset:]
+                n_half = int(audio.size(1)/2)
+                audio_0 = audio[:, :n_half, :]
+                audio_1 = audio[:, n_half:, :]
+                coupled = workspace.get('coupled', audio.size(), audio_like)
+                x_a = coupled[:, :n_half, :]
+                x_b = coupled[:, n_half:, :]
+                if wn1_outputs is None:
+                    with profile('WN1.%d' % k):
+                        t_1, log_s1 = self.infer_wn1(spect, k, workspace)
+                else:
+                    t_1, log_s1 = wn1_outputs[k]
+                torch.sub(audio_0, t_1, out=x_a).div_(log_s1.float().exp_())
+                #(y_1+audio_0)/2就是audio_0
+                with profile('WN2.%d' % k):
+                    wn2_cond, = self.cond_projection(spect, k, ('WN2',), cache=True)
+                    output2 = self.WN2[k].forward_cond(audio_0, wn2_cond)
+                log_s2 = output2[:, n_half:, :]
+                t_2 = output2[:, :n_half, :]
+                torch.sub(audio_1, t_2, out=x_b).div_(log_s2.float().exp_())
+                with profile('convinv.%d' % k), \
+                        torch.autocast(coupled.device.type, enabled=False):
+                    W_inverse = self.convinv[k].inverse_weight(coupled.dtype).squeeze(2)
+                    torch.matmul(W_inverse, coupled, out=audio)
+                if k % self.n_early_every == 0 and k > 0:
+                    offset -= self.n_early_size
+                    torch.mul(z_early[n_early], sigma,
+                              out=audio_buffer[:, offset:offset+self.n_early_size])
+                    n_early += 1
+        return audio_buffer.permute(0, 2, 1).reshape(batch_size, -1)
+
+    def cond_projection(self, spect, k, modules=('WN1', 'WN2'), cache=False):
+        """
+        The cond_layer projections of the squeezed spectrogram for the WN
+        modules of flow k named in modules (WN1[k] and/or WN2[k]), called
+        right before the flow uses them, so that at most one flow's
+        conditioning exists at a time.  forward projects both modules as
+        one 1x1 convolution with their weights stacked.  infer (cache=True)
+        projects one module at a time: under a reduced precision with its
+        rows of stacked_cond_weight, kept already cast, otherwise with its
+        own cond_layer.  Returns one tensor per module, to pass to
+        WN.forward_cond.
+        """
+        wns = [getattr(self, name)[k] for name in modules]
+        if not fusable_wn(list(self.WN1) + list(self.WN2)):
+            return [wn.cond_layer(spect) for wn in wns]
+        if cache and getattr(self, 'autocast_dtype', None) is not None:
+            # flow k的WN1、WN2在stacked_cond_weight中相邻，取一段view
+            n_cond_channels = wns[0].cond_layer.out_channels
+            first = 2*k + ('WN1', 'WN2').index(modules[0])
+            if first + len(wns) > 2*k + 2:
+                raise Exception("modules must be WN1 and/or WN2 in that order")
+            rows = slice(first * n_cond_channels, (first + len(wns)) * n_cond_channels)
+            weight, bias = self.stacked_cond_weight()
+            weight, bias = weight[rows], bias[rows]
+            # 低精度下1*1卷积比同样的矩阵乘慢得多（CPU上的bf16）
+            conds = torch.matmul(weight.squeeze(2), spect).add_(bias[:, None])
+        elif cache or len(wns) == 1:
+            #fp32下stacked_cond_weight的行和cond_layer的权重完全相同，直接用
+            return [wn.cond_layer(spect) for wn in wns]
+        else:
+            weight = torch.cat([_conv_weight(wn.cond_layer) for wn in wns], 0)
+            bias = torch.cat([wn.cond_layer.bias for wn in wns], 0)
+            conds = F.conv1d(spect, weight, bias)
+        return conds.split([wn.cond_layer.out_channels for wn in wns], 1)
+
+    def keep_weights(self):
+        """
+        Whether infer may keep derived weights (grouped_upsample_weight,
+        stacked_cond_weight) between calls: not under autograd or in
+        training mode.  forward never keeps them, so validation during
+        training leaves none behind.  Neither while tracing, where a kept
+        tensor would be stored in the graph as a constant next to the
+        parameters it was derived from.
+        """
+        return not (torch.is_grad_enabled() or self.training
+                    or torch.jit.is_tracing())
+
+    def stacks_cond_weight(self, device):
+        """
+        Whether infer on device uses stacked_cond_weight: under a reduced
+        precision, which it keeps already cast, and for the grouped WN1 pass
+        on CUDA.  In fp32 on CPU it would only copy the cond_layer weights.
+        """
+        return fusable_wn(list(self.WN1) + list(self.WN2)) and (
+            getattr(self, 'autocast_dtype', None) is not None
+            or torch.device(device).type == 'cuda')
+
+    def stacked_cond_weight(self):
+        """
+        The cond_layer weights and biases of all WN modules concatenated flow
+        by flow, WN1[k] before WN2[k], in the reduced precision of
+        set_precision if any.  Kept until any of the weights changes when
+        keep_weights allows, instead of being concatenated (and cast) again
+        on every call.
+        """
+        wns = [wn for k in range(self.n_flows) for wn in (self.WN1[k], self.WN2[k])]
+        autocast_dtype = getattr(self, 'autocast_dtype', None)
+        key = (autocast_dtype,) + tuple(
+            (p.data_ptr(), p._version) for wn in wns
+            for p in wn.cond_layer.parameters())
+        cache = self.keep_weights()
+        if not cache or getattr(self, 'cond_weight_key', None) != key:
+            weight = torch.cat([_conv_weight(wn.cond_layer) for wn in wns], 0)
+            bias = torch.cat([wn.cond_layer.bias for wn in wns], 0)
+            if autocast_dtype is not None:
+                weight, bias = weight.to(autocast_dtype), bias.to(autocast_dtype)
+            if not cache:
+                return weight, bias
+            self.cond_weight, self.cond_bias = weight, bias
+            self.cond_weight_key = key
+        return self.cond_weight, self.cond_bias
+
+    def infer_wn1(self, spect, k, workspace=None):
+        """
+        (t_1, log_s1) of WN1[k] in infer, where it is always fed an all-zero
+        audio half (taken from workspace when given), so that its outputs
+        depend on the squeezed spectrogram only.
+        """
+        n_half = int(self.convinv[k].conv.in_channels/2)
+        shape = (spect.size(0), n_half, spect.size(2))
+        if workspace is None:
+            y_0 = spect.new_zeros(shape)
+        else:
+            y_0 = workspace.get('zeros', shape, spect, zero=True)
+        wn1_cond, = self.cond_projection(spect, k, ('WN1',), cache=True)
+        output1 = self.WN1[k].forward_cond(y_0, wn1_cond)
+        return output1[:, :n_half, :], output1[:, n_half:, :]
+
+    def group_wn1(self, spect):
+        """
+        Whether infer evaluates all WN1 modules up front (infer_wn1_grouped)
+        rather than flow by flow.  Only on CUDA: on CPU the grouped pass is
+        slower than the per-flow one and holds the activations of all flows.
+        """
+        return spect.device.type == 'cuda' and self.stacks_cond_weight(spect.device)
+
+    def infer_wn1_grouped(self, spect, workspace=None):
+        """
+        infer_wn1 of all n_flows up front, as one grouped pass (grouped_wn)
+        whose layer i projects only its own rows of the stacked cond_layer
+        weights.  Returns (t_1, log_s1) per flow.
+        """
+        wn = self.WN1[0]
+        shapes = [(spect.size(0), int(self.convinv[k].conv.in_channels/2),
+                   spect.size(2)) for k in range(self.n_flows)]
+        if workspace is None:
+            y_0 = [spect.new_zeros(shape) for shape in shapes]
+        else:
+            y_0 = [workspace.get('zeros', shape, spect, zero=True)
+                   for shape in shapes]
+        weight, bias = self.stacked_cond_weight()
+        # n_flows x (WN1, WN2) x n_layers x 2*n_channels行
+        weight = weight.view(self.n_flows, 2, wn.n_layers, 2*wn.n_channels, -1)[:, 0]
+        bias = bias.view(self.n_flows, 2, wn.n_layers, 2*wn.n_channels)[:, 0]
+
+        def layer_cond(i):
+            return F.conv1d(spect, weight[:, i].reshape(-1, weight.size(-1), 1),
+                            bias[:, i].reshape(-1))
+
+        outputs = grouped_wn(self.WN1, y_0, layer_cond)
+        return [(output1[:, :y.size(1), :], output1[:, y.size(1):, :])
+                for y, output1 in zip(y_0, outputs)]
+
+    def optimize_for_inference(self):
+        """
+        Precomputes the inverse of every Invertible1x1Conv as a buffer, the
+        grouped upsample weight and, where infer uses them (stacks_cond_weight,
+        which depends on set_precision, so call it after that), the stacked
+        cond_layer weights, so the first infer call does not pay for them.
+        The stacked weights are a second copy of all cond_layer weights.
+        Processes forked afterwards share these caches copy-on-write instead
+        of each building its own.  All of them are rebuilt automatically when
+        the weights change or move (e.g. share_memory), so call this again
+        after that, before forking.
+        """
+        self.eval()
+        for convinv in self.convinv:
+            convinv.inverse_weight()
+        with torch.no_grad():
+            self.grouped_upsample_weight(cache=True)
+            if self.stacks_cond_weight(self.upsample.weight.device):
+                self.stacked_cond_weight()
+            else:
+                self.cond_weight = self.cond_bias = self.cond_weight_key = None
+        return self
+
     @staticmethod
     def remove_weightnorm(model):
         waveglow = model
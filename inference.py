@@ -26,83 +26,624 @@
 # *****************************************************************************
 import time
 import os
+import queue
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from scipy.io.wavfile import write
 import torch
-from mel2samp import files_to_list, MAX_WAV_VALUE
+from mel2samp import files_to_list, MAX_WAV_VALUE, MEL_PAD_VALUE
 from denoiser import Denoiser
+import glow
+from glow import InferenceWorkspace
+from feature_store import ShardReader
 from tqdm import tqdm
-def main(mel_files, waveglow_path, sigma, output_dir, sampling_rate, is_fp16,
-         denoiser_strength,tnum):
-    mel_files = files_to_list(mel_files)#测试集mel谱list
-    waveglow = torch.load(waveglow_path.replace('U',str(tnum)))['model']#加载模型
-    waveglow = waveglow.remove_weightnorm(waveglow)#？移除权重归一化
-    waveglow.cuda().eval()#cuda()拷贝进gpu #？变成测试模式，dropout和BN在训练时和测不一样
-    #apex加速
-    
-    if is_fp16:
-        from apex import amp
-        waveglow, _ = amp.initialize(waveglow, [], opt_level="O3")
-    
-    # denoiser_strength=0
-    if denoiser_strength > 0:
-        denoiser = Denoiser(waveglow).cuda()
-    st = time.time()
-    for i, file_path in enumerate(tqdm(mel_files)):
-        #file_name-对应的wav
-        file_name = os.path.splitext(os.path.basename(file_path))[0]
-        #加载MFCC特征，80个滤波器
-        mel = torch.load(file_path)
-        #mel={key:mel[key].cuda() for key in mel}
-        #封装数据
-        mel = torch.autograd.Variable(mel.cuda())
-        #80，375 -> 1*80*375
+import numpy as np
+
+#--precision对应的autocast精度
+PRECISIONS = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def stream_noise(waveglow, batch_size, start, end, seed, device, dtype,
+                 block_size=4096):
+    """
+    Unit normal noise for squeezed time steps [start, end) of one utterance.
+    Noise is drawn in fixed blocks seeded by their index, so overlapping
+    chunks see exactly the same values without holding the whole utterance.
+    """
+    blocks = []
+    for block in range(start // block_size, (end - 1) // block_size + 1):
+        generator = torch.Generator().manual_seed(seed * 1000003 + block)
+        blocks.append(torch.randn(batch_size, waveglow.n_group, block_size,
+                                  generator=generator))
+    noise = torch.cat(blocks, 2)
+    offset = (start // block_size) * block_size
+    noise = noise[:, :, start - offset:end - offset]
+    return noise.to(device=device, dtype=dtype)
+
+
+def infer_stream(waveglow, mel, sigma=1.0, chunk_frames=64, context_frames=None,
+                 fade_samples=256, denoiser=None, denoiser_strength=0.0,
+                 seed=None, workspace=None):
+    """
+    Generator version of waveglow.infer for one mel (n_mel_channels x frames).
+    The mel is cut into chunk_frames pieces, each run with context_frames of
+    mel on both sides (defaults to waveglow.receptive_field()) and the
+    context audio dropped.  Consecutive chunks are cross-faded over
+    fade_samples.  Yields int16 numpy arrays.  workspace is an optional
+    InferenceWorkspace reused by every chunk.
+    """
+    if mel.dim() == 2:
         mel = torch.unsqueeze(mel, 0)
-        #变成fp16数据以便apex加速
-        mel = mel.half() if is_fp16 else mel
-        #反向传播不会自动求导
+    if context_frames is None:
+        context_frames = waveglow.receptive_field()
+    if seed is None:
+        seed = int(torch.randint(0, 2**31 - 1, (1,)).item())
+    hop_length = waveglow.upsample.stride[0]
+    n_group = waveglow.n_group
+    # the fade region is taken from the next chunk's left context
+    fade_samples = min(fade_samples, context_frames * hop_length,
+                       chunk_frames * hop_length)
+    n_frames = mel.size(2)
+    fade_in = torch.linspace(0.0, 1.0, fade_samples + 2)[1:-1]
+    tail = None
+    for chunk_start in range(0, n_frames, chunk_frames):
+        chunk_end = min(chunk_start + chunk_frames, n_frames)
+        context_start = max(0, chunk_start - context_frames)
+        context_end = min(n_frames, chunk_end + context_frames)
+        z = stream_noise(waveglow, mel.size(0),
+                         context_start * hop_length // n_group,
+                         context_end * hop_length // n_group,
+                         seed, mel.device, mel.dtype)
         with torch.no_grad():
-            #生成1*96000Tensor数据,x为原始音频，z为mel谱
-
-            audio = waveglow.infer(mel, sigma=sigma)
-            #audio = preEmphasis(audio)
+            audio = waveglow.infer(mel[:, :, context_start:context_end],
+                                   sigma=sigma, z=z, workspace=workspace)
             if denoiser_strength > 0:
                 audio = denoiser(audio, denoiser_strength)
-            #为了转成wav？
-            audio = audio * MAX_WAV_VALUE
-        #变成1维数据
-        audio = audio.squeeze()
-        #在cpu中转成numpy
-        audio = audio.cpu().numpy()
-        #预加重
-        # audio = preEmphasis(audio)
-        #改变类型
-        audio = audio.astype('int16')
-        #生成数据存储位置
-        if not os.path.exists(output_dir.replace('1',str(tnum))):
-            os.makedirs(output_dir.replace('1',str(tnum)))
-        audio_path = os.path.join(
-            output_dir.replace('1',str(tnum)), "{}".format(file_name))
-        write(audio_path, sampling_rate, audio)
-        #写入音频
-        print(audio_path)
-    print(time.time()-st)
+        audio = audio.reshape(-1).float().cpu()
+
+        # samples [chunk_start*hop, chunk_end*hop) relative to this chunk
+        core_start = (chunk_start - context_start) * hop_length
+        core_end = core_start + (chunk_end - chunk_start) * hop_length
+        if tail is not None:
+            overlap = audio[core_start - tail.size(0):core_start]
+            blended = tail * (1 - fade_in[:tail.size(0)]) + \
+                overlap * fade_in[:tail.size(0)]
+            out = torch.cat([blended, audio[core_start:core_end]])
+        else:
+            out = audio[core_start:core_end]
+        if chunk_end < n_frames and fade_samples > 0:
+            tail = out[-fade_samples:]
+            out = out[:-fade_samples]
+        out = torch.clamp(out * MAX_WAV_VALUE, -MAX_WAV_VALUE, MAX_WAV_VALUE - 1)
+        yield out.numpy().astype('int16')
+
+
+_sweep_mels = None
+
+
+def _init_sweep_worker(loaded_mels, num_threads):
+    global _sweep_mels
+    _sweep_mels = loaded_mels
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
+def _sweep_job(job):
+    tnum, kwargs = job
+    main(tnum=tnum, loaded_mels=_sweep_mels, **kwargs)
+    return tnum
+
+
+def sweep(mel_files, checkpoint_ids, num_workers=1, num_threads=0, **kwargs):
+    """
+    Runs main for every checkpoint id, reading the mel filelist only once.
+    With num_workers > 1 the checkpoints are spread over worker processes
+    that get the mels through shared memory, each limited to num_threads
+    (defaults to an even share of the cores).  A single checkpoint reads
+    the mels through the prefetching pipeline instead.
+    """
+    kwargs['mel_files'] = mel_files
+    if len(checkpoint_ids) == 1:
+        main(tnum=checkpoint_ids[0], **kwargs)
+        return
+    loaded_mels = load_mels(mel_files)
+    if num_workers <= 1:
+        for tnum in checkpoint_ids:
+            main(tnum=tnum, loaded_mels=loaded_mels, **kwargs)
+        return
+    if kwargs.get('workers', 1) > 1:
+        raise Exception("use either --sweep_workers or --workers")
+    for mel in loaded_mels[1]:
+        mel.share_memory_()
+    if num_threads <= 0:
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    context = torch.multiprocessing.get_context('spawn')
+    with context.Pool(num_workers, initializer=_init_sweep_worker,
+                      initargs=(loaded_mels, num_threads)) as pool:
+        for tnum in pool.imap_unordered(
+                _sweep_job, [(tnum, kwargs) for tnum in checkpoint_ids]):
+            print("checkpoint {} done".format(tnum))
+
+
+def infer_batch(waveglow, mels, sigma=1.0, denoiser=None, denoiser_strength=0.0,
+                workspace=None):
+    """
+    Runs waveglow.infer once for a list of mels (n_mel_channels x frames).
+    Shorter mels are padded to the longest with silence and every output is
+    trimmed back to its own frames*hop_length samples.  With an
+    InferenceWorkspace the padded batch and the flow buffers are reused
+    between calls.
+    """
+    hop_length = waveglow.upsample.stride[0]
+    max_frames = max(mel.size(1) for mel in mels)
+    shape = (len(mels), mels[0].size(0), max_frames)
+    if workspace is None:
+        batch = mels[0].new_full(shape, MEL_PAD_VALUE)
+    else:
+        batch = workspace.get('mels', shape, mels[0]).fill_(MEL_PAD_VALUE)
+    for j, mel in enumerate(mels):
+        batch[j, :, :mel.size(1)] = mel
+    with torch.no_grad():
+        audio = waveglow.infer(batch, sigma=sigma, workspace=workspace)
+        if denoiser_strength > 0:
+            audio = denoiser(audio, denoiser_strength)
+    audio = audio.view(len(mels), -1)
+    return [audio[j, :mel.size(1)*hop_length] for j, mel in enumerate(mels)]
+
+
+def save_audio(audio, output_dir, file_name, sampling_rate):
+    """Writes float audio in [-1, 1] as an int16 wav, returns its path"""
+    #在cpu中转成numpy并改变类型
+    audio = (audio * MAX_WAV_VALUE).float().cpu().numpy().astype('int16')
+    #生成数据存储位置
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    audio_path = os.path.join(output_dir, "{}".format(file_name))
+    write(audio_path, sampling_rate, audio)
+    return audio_path
+
+
+def _prefetch(mel_source, batch_size, window, device, batches, timings):
+    """
+    Loading stage of pipeline.  mel_source gives (file_name, mel) pairs where
+    mel is anything load_mel takes.  Every window mels are sorted by length
+    and put on the bounded batches queue, None marks the end.
+    """
+    pending = []
+
+    def flush():
+        pending.sort(key=lambda item: item[1].size(1), reverse=True)
+        for j in range(0, len(pending), batch_size):
+            batches.put(pending[j:j+batch_size])
+        del pending[:]
+
+    try:
+        for file_name, mel in mel_source:
+            st = time.time()
+            mel = load_mel(mel, device)
+            timings['load'] += time.time() - st
+            pending.append((file_name, mel))
+            if len(pending) >= window:
+                flush()
+        flush()
+    except Exception as e:
+        batches.put(e)
+    batches.put(None)
+
+
+def pipeline(waveglow, mel_source, output_dir, sampling_rate, sigma=1.0,
+             denoiser=None, denoiser_strength=0.0, device='cuda',
+             batch_size=1, prefetch=4, num_writers=2, workspace=None):
+    """
+    Synthesizes mel_source with three overlapping stages: a thread loading
+    mels into a queue of at most prefetch batches, infer_batch on the calling
+    thread and a pool of num_writers threads converting and writing the
+    wavs.  Returns (utterances, samples, timings) with the seconds spent in
+    each stage.
+    """
+    timings = {'load': 0.0, 'compute': 0.0, 'write': 0.0}
+    lock = threading.Lock()
+    batches = queue.Queue(maxsize=max(1, prefetch))
+    loader = threading.Thread(
+        target=_prefetch, daemon=True,
+        args=(mel_source, batch_size, max(1, prefetch) * batch_size, device,
+              batches, timings))
+    loader.start()
+
+    def write_job(audio, file_name):
+        st = time.time()
+        audio_path = save_audio(audio, output_dir, file_name, sampling_rate)
+        with lock:
+            timings['write'] += time.time() - st
+        return audio_path
+
+    num_utterances, num_samples = 0, 0
+    writes = collections.deque()
+    with ThreadPoolExecutor(max(1, num_writers)) as writers:
+        progress = tqdm()
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            st = time.time()
+            if glow.profiler is not None:
+                glow.profiler.begin()
+            audios = infer_batch(waveglow, [mel for _, mel in batch], sigma=sigma,
+                                 denoiser=denoiser,
+                                 denoiser_strength=denoiser_strength,
+                                 workspace=workspace)
+            #GPU上异步执行，等kernel跑完再计时，否则计算时间会算到写盘里
+            if torch.device(device).type == 'cuda':
+                torch.cuda.synchronize()
+            if glow.profiler is not None:
+                glow.profiler.end(','.join(file_name for file_name, _ in batch),
+                                  sum(audio.size(0) for audio in audios),
+                                  sampling_rate)
+            timings['compute'] += time.time() - st
+            for (file_name, _), audio in zip(batch, audios):
+                num_utterances += 1
+                num_samples += audio.size(0)
+                writes.append(writers.submit(write_job, audio, file_name))
+            #限制待写的音频数，写盘慢时计算也要等
+            while len(writes) > 2 * max(1, num_writers) * batch_size:
+                print(writes.popleft().result())
+            progress.update(len(batch))
+        progress.close()
+        while writes:
+            print(writes.popleft().result())
+    loader.join()
+    return num_utterances, num_samples, timings
+
+
+_pool_state = None
+
+
+def _init_pool_worker(num_threads):
+    torch.set_num_threads(num_threads)
+    #fork出的进程继承同一个随机数状态，重新播种避免各进程的噪声相同
+    torch.seed()
+
+
+def _pool_job(indices):
+    """Worker side of infer_pool: synthesizes and writes one batch"""
+    waveglow, denoiser, workspace, items, options = _pool_state
+    st = time.time()
+    batch = [items[j] for j in indices]
+    mels = [load_mel(mel) for _, mel in batch]
+    audios = infer_batch(waveglow, mels, sigma=options['sigma'],
+                         denoiser=denoiser,
+                         denoiser_strength=options['denoiser_strength'],
+                         workspace=workspace)
+    audio_paths = [save_audio(audio, options['output_dir'], file_name,
+                              options['sampling_rate'])
+                   for (file_name, _), audio in zip(batch, audios)]
+    return (audio_paths, sum(audio.size(0) for audio in audios),
+            time.time() - st, os.getpid())
+
+
+def infer_pool(waveglow, mel_source, output_dir, sampling_rate, sigma=1.0,
+               denoiser=None, denoiser_strength=0.0, batch_size=1,
+               num_workers=2, num_threads=0):
+    """
+    CPU version of pipeline for large filelists: num_workers forked processes
+    each load, synthesize and write whole batches with num_threads intra-op
+    threads (defaults to an even share of the cores).  The weights are moved
+    to shared memory before forking, so every worker maps the same copy.
+    Batches are ordered longest first and handed out one at a time to
+    whichever worker is free, so no worker sits idle while another still
+    has a queue of long utterances.  Returns (utterances, samples, timings)
+    with the compute seconds of each worker.
+    """
+    global _pool_state
+    if num_threads <= 0:
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    #权重放进共享内存后再缓存逆矩阵等，fork出的进程都映射同一份
+    waveglow.share_memory()
+    waveglow.optimize_for_inference()
+    if denoiser is not None:
+        denoiser.share_memory()
+    #没加载的mel用文件大小估计长度
+    items = list(mel_source)
+    lengths = [os.path.getsize(mel) if isinstance(mel, str) else
+               mel.shape[0] if isinstance(mel, np.ndarray) else mel.size(1)
+               for _, mel in items]
+    order = sorted(range(len(items)), key=lambda j: lengths[j], reverse=True)
+    jobs = [order[j:j+batch_size] for j in range(0, len(order), batch_size)]
+    # workers inherit this through fork, only the indices go through the queue
+    _pool_state = (waveglow, denoiser, InferenceWorkspace(), items,
+                   {'sigma': sigma, 'denoiser_strength': denoiser_strength,
+                    'output_dir': output_dir, 'sampling_rate': sampling_rate})
+    num_utterances, num_samples = 0, 0
+    timings = collections.defaultdict(float)
+    context = torch.multiprocessing.get_context('fork')
+    try:
+        with context.Pool(num_workers, initializer=_init_pool_worker,
+                          initargs=(num_threads,)) as pool:
+            for audio_paths, samples, seconds, pid in tqdm(
+                    pool.imap_unordered(_pool_job, jobs), total=len(jobs)):
+                for audio_path in audio_paths:
+                    print(audio_path)
+                num_utterances += len(audio_paths)
+                num_samples += samples
+                timings['worker {}'.format(pid)] += seconds
+    finally:
+        _pool_state = None
+    return num_utterances, num_samples, dict(timings)
+
+
+def load_waveglow(waveglow_path, device='cuda', precision='fp32',
+                  denoiser_strength=0.0, int8_calibration=None, sigma=1.0):
+    """
+    Loads a checkpoint ready for inference, returns (waveglow, denoiser) with
+    denoiser None unless denoiser_strength > 0.  precision is one of
+    PRECISIONS, fp16 and bf16 run infer under torch.autocast.
+    """
+    if precision == 'fp16' and not str(device).startswith('cuda'):
+        raise Exception("fp16 autocast needs a GPU, use bf16 on CPU")
+    if precision != 'fp32' and int8_calibration is not None:
+        raise Exception("int8 quantization needs precision fp32")
+    if int8_calibration is not None and torch.device(device).type != 'cpu':
+        raise Exception("int8 quantization only runs on CPU, use --device cpu")
+    #加载模型，权重直接映射到目标设备，CPU机器上也能加载GPU训练的checkpoint
+    waveglow = torch.load(waveglow_path, map_location=device)['model']
+    waveglow = waveglow.remove_weightnorm(waveglow)#？移除权重归一化
+    waveglow.to(device).eval()#？变成测试模式，dropout和BN在训练时和测不一样
+    #int8量化，用一组mel谱标定激活值范围，只支持CPU
+    if int8_calibration is not None:
+        from quantize import quantize_waveglow
+        calibration_mels = [torch.load(f, map_location='cpu')
+                            for f in files_to_list(int8_calibration)]
+        waveglow = quantize_waveglow(waveglow, calibration_mels, sigma)
+    #autocast混合精度，exp(log_s)和1*1卷积的逆保持fp32
+    waveglow.set_precision(PRECISIONS[precision])
+    #预先求出所有1*1卷积的逆矩阵
+    waveglow.optimize_for_inference()
+    # denoiser_strength=0
+    denoiser = None
+    if denoiser_strength > 0:
+        denoiser = Denoiser(waveglow)
+    return waveglow, denoiser
+
+
+def list_mels(mel_files):
+    """
+    (file_name, mel) pairs of mel_files, with file_name the name of the
+    corresponding wav.  mel_files is either a filelist of .pt mels (mel is
+    the path) or a store written by mel2samp.py --store (mel is a
+    memory-mapped frames x n_mel_channels array)
+    """
+    if os.path.isdir(mel_files):
+        store = ShardReader(mel_files)
+        return [(os.path.basename(utterance['name']), store.get(j, 'mel'))
+                for j, utterance in enumerate(store.utterances)]
+    mel_paths = files_to_list(mel_files)#测试集mel谱list
+    return [(os.path.splitext(os.path.basename(file_path))[0], file_path)
+            for file_path in mel_paths]
+
+
+def load_mel(mel, device='cpu'):
+    """A mel from list_mels (or already a tensor) as n_mel_channels x frames on device"""
+    if isinstance(mel, str):
+        mel = torch.load(mel, map_location='cpu')
+    elif isinstance(mel, np.ndarray):
+        mel = torch.from_numpy(np.ascontiguousarray(mel.T))
+    return mel.to(device)
+
+
+def load_mels(mel_files):
+    """
+    Reads every mel of a filelist to the CPU, returns (file_names, mels) with
+    file_name the name of the corresponding wav
+    """
+    #加载MFCC特征，80个滤波器，file_name-对应的wav
+    file_names, mels = [], []
+    for file_name, mel in list_mels(mel_files):
+        file_names.append(file_name)
+        mels.append(load_mel(mel))
+    return file_names, mels
+
+
+def report_profile(profiler, tnum, profile_path=None, profile_logdir=None):
+    """Prints the slowest stages and exports the profiler report"""
+    summary = profiler.summary()
+    key = profiler.memory_key
+    print("profiled {} utterances RTF {:.4f}".format(summary['utterances'],
+                                                     summary['rtf']) +
+          ("" if key is None else " {} {:.1f}MB".format(key, summary[key] / 2**20)))
+    stages = sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds'])
+    for name, stage in stages[:10]:
+        print("  {:<12s} {:.3f}s".format(name, stage['seconds']) +
+              ("" if key is None else " {:.1f}MB".format(stage[key] / 2**20)))
+    if profile_path is not None:
+        root, ext = os.path.splitext(profile_path)
+        profiler.to_json("{}_{}{}".format(root, tnum, ext or '.json'))
+    if profile_logdir is not None:
+        from tensorboardX import SummaryWriter
+        logger = SummaryWriter(os.path.join(profile_logdir, str(tnum)))
+        profiler.log(logger)
+        logger.close()
+
+
+def main(mel_files, waveglow_path, sigma, output_dir, sampling_rate, precision,
+         denoiser_strength,tnum, device='cuda', chunk_frames=0,
+         context_frames=None, batch_size=1, int8_calibration=None,
+         loaded_mels=None, prefetch=4, num_writers=2, profile_path=None,
+         profile_logdir=None, workers=1, worker_threads=0):
+    """
+    Synthesizes every mel of mel_files with checkpoint tnum.  loaded_mels
+    can pass the result of load_mels to skip reading the filelist again,
+    otherwise the mels are read while the model runs.  profile_path and
+    profile_logdir turn on the per-stage profiler and receive its report as
+    JSON (with _<tnum> before the extension) and as tensorboardX scalars.
+    workers > 1 runs infer_pool with worker_threads threads per worker.
+    """
+    if workers > 1:
+        if device != 'cpu':
+            raise Exception("--workers is for CPU inference")
+        if chunk_frames > 0 or profile_path is not None or profile_logdir is not None:
+            raise Exception("--workers does not support --chunk_frames or --profile")
+    output_dir = output_dir.replace('1',str(tnum))
+    waveglow, denoiser = load_waveglow(
+        waveglow_path.replace('U',str(tnum)), device, precision,
+        denoiser_strength, int8_calibration, sigma)
+    #整个文件列表共用一套预分配的buffer
+    workspace = InferenceWorkspace()
+    if profile_path is not None or profile_logdir is not None:
+        glow.profiler = glow.Profiler(device)
+
+    st = time.time()
+    num_samples = 0
+    num_threads = torch.get_num_threads()
+    if workers > 1:
+        if loaded_mels is None:
+            mel_source = list_mels(mel_files)
+        else:
+            mel_source = zip(*loaded_mels)
+        num_utterances, num_samples, timings = infer_pool(
+            waveglow, mel_source, output_dir, sampling_rate, sigma=sigma,
+            denoiser=denoiser, denoiser_strength=denoiser_strength,
+            batch_size=batch_size, num_workers=workers,
+            num_threads=worker_threads)
+        num_threads = workers * (worker_threads if worker_threads > 0 else
+                                 max(1, (os.cpu_count() or 1) // workers))
+        print("compute " + " ".join("{:.2f}s".format(seconds)
+                                    for seconds in timings.values()))
+    elif chunk_frames > 0:
+        if loaded_mels is None:
+            loaded_mels = load_mels(mel_files)
+        file_names, mels = loaded_mels
+        mels = [mel.to(device) for mel in mels]
+        num_utterances = len(mels)
+        for file_name, mel in zip(file_names, tqdm(mels)):
+            #流式合成，逐块输出int16
+            chunk_st = time.time()
+            chunks = []
+            if glow.profiler is not None:
+                glow.profiler.begin()
+            for chunk in infer_stream(waveglow, mel, sigma=sigma,
+                                      chunk_frames=chunk_frames,
+                                      context_frames=context_frames,
+                                      denoiser=denoiser,
+                                      denoiser_strength=denoiser_strength,
+                                      workspace=workspace):
+                if not chunks:
+                    print("first chunk after {:.3f}s".format(time.time()-chunk_st))
+                chunks.append(chunk)
+            audio = np.concatenate(chunks)
+            if glow.profiler is not None:
+                glow.profiler.end(file_name, audio.shape[0], sampling_rate)
+            num_samples += audio.shape[0]
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            audio_path = os.path.join(output_dir, "{}".format(file_name))
+            write(audio_path, sampling_rate, audio)
+            print(audio_path)
+    else:
+        #读mel、合成、写wav三段流水并行；没有预加载时边读边算
+        if loaded_mels is None:
+            mel_source = list_mels(mel_files)
+        else:
+            mel_source = zip(*loaded_mels)
+        num_utterances, num_samples, timings = pipeline(
+            waveglow, mel_source, output_dir, sampling_rate, sigma=sigma,
+            denoiser=denoiser, denoiser_strength=denoiser_strength,
+            device=device, batch_size=batch_size,
+            prefetch=prefetch, num_writers=num_writers, workspace=workspace)
+        print("load {:.2f}s compute {:.2f}s write {:.2f}s".format(
+            timings['load'], timings['compute'], timings['write']))
+    elapsed = time.time()-st
+    print(elapsed)
+    print("{:.2f} utterances/s".format(num_utterances / elapsed))
+    if workers <= 1:
+        print("workspace {:.1f}MB".format(workspace.nbytes() / 2**20))
+    if glow.profiler is not None:
+        report_profile(glow.profiler, tnum, profile_path, profile_logdir)
+        glow.profiler = None
+    #实时率RTF=合成耗时/音频时长，CPU上同时给出每个核的RTF
+    audio_seconds = num_samples / float(sampling_rate)
+    if audio_seconds > 0:
+        rtf = elapsed / audio_seconds
+        print("device {} threads {} RTF {:.4f} RTF/core {:.4f}".format(
+            device, num_threads, rtf,
+            rtf * num_threads if device == 'cpu' else rtf))
 
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-f', "--filelist_path", required=True)
+    parser.add_argument('-f', "--filelist_path", required=True,
+                        help='filelist of .pt mels or a mel2samp.py --store directory')
     parser.add_argument('-w', '--waveglow_path',
                         help='Path to waveglow decoder checkpoint with model')
     parser.add_argument('-o', "--output_dir", required=True)
     parser.add_argument("-s", "--sigma", default=1.0, type=float)
     parser.add_argument("--sampling_rate", default=22050, type=int)
-    parser.add_argument("--is_fp16", action="store_true")
+    parser.add_argument("--precision", default='fp32', choices=sorted(PRECISIONS),
+                        help='fp16 (GPU) or bf16 (GPU/CPU) run infer under autocast')
+    parser.add_argument("--is_fp16", action="store_true",
+                        help='same as --precision fp16')
     parser.add_argument("-d", "--denoiser_strength", default=0.0, type=float,
                         help='Removes model bias. Start with 0.1 and adjust')
+    parser.add_argument("--device", default=None,
+                        help='cuda or cpu, defaults to cuda when available')
+    parser.add_argument("--num_threads", default=0, type=int,
+                        help='intra-op threads for CPU inference, 0 keeps torch default')
+    parser.add_argument("--num_interop_threads", default=0, type=int,
+                        help='inter-op threads for CPU inference, 0 keeps torch default')
+
+    parser.add_argument("--chunk_frames", default=0, type=int,
+                        help='stream the output in chunks of this many mel frames')
+    parser.add_argument("--context_frames", default=None, type=int,
+                        help='mel frames of overlap on each side of a chunk, '
+                             'defaults to the model receptive field')
+    parser.add_argument("-b", "--batch_size", default=1, type=int,
+                        help='number of length-sorted utterances per infer call')
+    parser.add_argument("--int8_calibration", default=None,
+                        help='mel filelist (e.g. mel_test.txt) to calibrate '
+                             'int8 quantization of the WN convs, CPU only')
+    parser.add_argument("--checkpoint_ids", default=list(range(1,15)), type=int,
+                        nargs='+',
+                        help='ids substituted for U in the checkpoint path '
+                             '(and 1 in the output dir) of the sweep')
+    parser.add_argument("--sweep_workers", default=1, type=int,
+                        help='worker processes evaluating checkpoints in parallel')
+    parser.add_argument("--prefetch", default=4, type=int,
+                        help='batches of mels loaded ahead of the model')
+    parser.add_argument("--num_writers", default=2, type=int,
+                        help='threads writing wavs in the background')
+    parser.add_argument("--workers", default=1, type=int,
+                        help='forked CPU processes sharing one copy of the '
+                             'weights, each taking the next free batch')
+    parser.add_argument("--worker_threads", default=0, type=int,
+                        help='intra-op threads of each --workers process, '
+                             '0 splits the cores evenly')
+    parser.add_argument("--profile", default=None,
+                        help='write per-flow/per-WN timings and RTF of every '
+                             'utterance to this JSON file')
+    parser.add_argument("--profile_logdir", default=None,
+                        help='also log the profile to tensorboardX in this directory')
 
     args = parser.parse_args()
-    for i in range(1,15):
-        main(args.filelist_path, args.waveglow_path, args.sigma, args.output_dir,
-         args.sampling_rate, args.is_fp16, args.denoiser_strength,i)
+    if args.is_fp16:
+        args.precision = 'fp16'
+    if args.device is None:
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    #线程数必须在第一次并行计算之前设置
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    if args.num_interop_threads > 0:
+        torch.set_num_interop_threads(args.num_interop_threads)
+    sweep(args.filelist_path, args.checkpoint_ids, args.sweep_workers,
+          args.num_threads, waveglow_path=args.waveglow_path, sigma=args.sigma,
+          output_dir=args.output_dir, sampling_rate=args.sampling_rate,
+          precision=args.precision, denoiser_strength=args.denoiser_strength,
+          device=args.device, chunk_frames=args.chunk_frames,
+          context_frames=args.context_frames, batch_size=args.batch_size,
+          int8_calibration=args.int8_calibration, prefetch=args.prefetch,
+          num_writers=args.num_writers, profile_path=args.profile,
+          profile_logdir=args.profile_logdir, workers=args.workers,
+          worker_threads=args.worker_threads)
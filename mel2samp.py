@@ -25,20 +25,24 @@
 #
 # *****************************************************************************\
 import os
+import math
 import random
+import bisect
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.utils.data
 import sys
 from scipy.io.wavfile import read
 import numpy as np
 
-# We're using the audio processing from TacoTron2 to make sure it matches
-sys.path.insert(0, 'tacotron2')
-from tacotron2.layers import TacotronSTFT
+# Same mel spectrograms as TacoTron2's TacotronSTFT, without the submodule
+from frontend import TacotronSTFT
 
 MAX_WAV_VALUE = 32768.0
+#log(1e-5)，即mel谱提取时幅度的下限，用来把短的mel补成静音
+MEL_PAD_VALUE = math.log(1e-5)
 
 def files_to_list(filename):
     """
@@ -59,20 +63,258 @@ def load_wav_to_torch(full_path):
     return torch.from_numpy(data).float(), sampling_rate
 
 
+def load_wav_segment(full_path, start, length):
+    """
+    Samples [start, start+length) of a wav, pre-emphasized like
+    load_wav_to_torch.  The file is memory-mapped, so only the segment and
+    the one sample before it (for the pre-emphasis) are read.
+    """
+    try:
+        sampling_rate, data = read(full_path, mmap=True)
+    except ValueError:
+        sampling_rate, data = read(full_path)
+    segment = data[max(start - 1, 0):start + length]
+    if start == 0:
+        segment = np.append(segment[0], segment[1:]-0.98*segment[:-1])
+    else:
+        segment = segment[1:]-0.98*segment[:-1]
+    return torch.from_numpy(segment).float(), sampling_rate
+
+
+def wav_info(full_path):
+    """
+    (samples, sampling_rate) of a wav, only the header is parsed
+    """
+    try:
+        sampling_rate, data = read(full_path, mmap=True)
+    except ValueError:
+        # mmap不支持的格式（如24bit）只能整个读
+        sampling_rate, data = read(full_path)
+    return data.shape[0], sampling_rate
+
+
+def voiced_ranges(audio, segment_length, step=1, threshold=1e-5):
+    """
+    The starts (in units of step) of the segment_length windows of audio
+    whose std is at least threshold, i.e. the windows Mel2Samp accepts, as
+    [first, last] runs.  Window stds come from float64 prefix sums, so the
+    whole file costs O(len(audio)).
+    """
+    n_starts = (len(audio) - segment_length) // step + 1
+    if n_starts <= 0:
+        return []
+    audio = np.asarray(audio, dtype=np.float64)
+    sums = np.concatenate([[0.0], np.cumsum(audio)])
+    squares = np.concatenate([[0.0], np.cumsum(audio * audio)])
+    starts = np.arange(n_starts) * step
+    s1 = sums[starts + segment_length] - sums[starts]
+    s2 = squares[starts + segment_length] - squares[starts]
+    #和torch.std一样是无偏估计
+    variance = (s2 - s1 * s1 / segment_length) / (segment_length - 1)
+    voiced = np.concatenate([[0], variance >= threshold**2, [0]]).astype(np.int8)
+    edges = np.flatnonzero(np.diff(voiced))
+    return [[int(first), int(last) - 1]
+            for first, last in zip(edges[::2], edges[1::2])]
+
+
+def run_counts(ranges):
+    """Cumulative lengths of [first, last] runs, for sample_start"""
+    return np.cumsum([last - first + 1 for first, last in ranges]).tolist()
+
+
+def sample_start(ranges, counts):
+    """A uniformly drawn start from the runs of voiced_ranges, O(log runs)"""
+    k = random.randint(0, counts[-1] - 1)
+    run = bisect.bisect_right(counts, k)
+    return ranges[run][0] + k - (counts[run - 1] if run else 0)
+
+
+def load_manifest(audio_files, manifest_path=None, num_workers=None,
+                  segment_length=None):
+    """
+    Returns {path: {'samples', 'sampling_rate', 'mtime', 'size'}} for
+    audio_files.  With segment_length the entries also get
+    'voiced': {str(segment_length): voiced_ranges(...)}, which needs the
+    whole file decoded once.  With manifest_path the entries are cached in
+    that JSON file: only files that are new, whose mtime/size changed or
+    that lack the voiced ranges are read again (num_workers threads in
+    parallel), and the file is rewritten atomically merged with whatever
+    other filelists put there.  Distributed training builds it on rank 0
+    only; the other ranks wait at a barrier and then just read it.
+    """
+    manifest = {}
+    if manifest_path is not None and os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    def stat(path):
+        st = os.stat(path)
+        return {'mtime': st.st_mtime, 'size': st.st_size}
+
+    def unchanged(entry, path):
+        current = stat(path)
+        return entry is not None and (entry['mtime'], entry['size']) == (
+            current['mtime'], current['size'])
+
+    def build(path):
+        old = manifest.get(os.path.abspath(path))
+        if unchanged(old, path):
+            entry = dict(old)
+        else:
+            entry = stat(path)
+            entry['samples'], entry['sampling_rate'] = wav_info(path)
+        entry['voiced'] = dict(entry.get('voiced', {}))
+        if segment_length is not None and str(segment_length) not in entry['voiced']:
+            audio, _ = load_wav_to_torch(path)
+            entry['voiced'][str(segment_length)] = voiced_ranges(
+                audio.numpy(), segment_length)
+        return path, entry
+
+    stale = []
+    for path in audio_files:
+        entry = manifest.get(os.path.abspath(path))
+        if not unchanged(entry, path) or (
+                segment_length is not None and
+                str(segment_length) not in entry.get('voiced', {})):
+            stale.append(path)
+    if stale:
+        with ThreadPoolExecutor(num_workers) as pool:
+            built = {os.path.abspath(path): entry
+                     for path, entry in pool.map(build, stale)}
+        manifest.update(built)
+        if manifest_path is not None:
+            #其他filelist可能同时写了，合并后用rename原子替换
+            if os.path.isfile(manifest_path):
+                with open(manifest_path) as f:
+                    merged = json.load(f)
+                merged.update(manifest)
+                manifest = merged
+            tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, manifest_path)
+    return {path: manifest[os.path.abspath(path)] for path in audio_files}
+
+
+def batch_mel(stft, audio):
+    """
+    Mels of a batch of segments (batch x samples, in [-1, 1]) in one call,
+    on whatever device stft and audio are.  Same values as Mel2Samp.get_mel
+    on each segment.
+    """
+    with torch.no_grad():
+        return stft.mel_spectrogram(audio)
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of indices of similar length whose padded size (batch size
+    times the longest length) stays within max_samples; an item longer
+    than max_samples gets a batch of its own.  With num_replicas > 1 it
+    shards like DistributedSampler: every rank gets the same number of
+    batches, dealt in groups of neighbouring lengths so that all ranks run
+    batches of about the same cost at each step.  Call set_epoch every
+    epoch to reshuffle.
+    """
+    def __init__(self, lengths, max_samples, num_replicas=1, rank=0, seed=1234):
+        self.lengths = lengths
+        self.max_samples = max_samples
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.epoch_batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.epoch_batches = None
+
+    def batches(self):
+        #每个rank用同样的种子，分出同样的batch
+        generator = random.Random(self.seed + self.epoch)
+        order = sorted(range(len(self.lengths)), reverse=True,
+                       key=lambda j: (self.lengths[j], generator.random()))
+        batches, batch = [], []
+        for j in order:
+            # 从长到短，batch[0]就是batch中最长的
+            if batch and (len(batch) + 1) * self.lengths[batch[0]] > self.max_samples:
+                batches.append(batch)
+                batch = []
+            batch.append(j)
+        if batch:
+            batches.append(batch)
+        #用最短的batch补齐成num_replicas的整数倍，每num_replicas个相邻的batch分给各rank
+        batches += batches[-1:] * (-len(batches) % self.num_replicas)
+        groups = [batches[k:k+self.num_replicas]
+                  for k in range(0, len(batches), self.num_replicas)]
+        generator.shuffle(groups)
+        return [group[self.rank] for group in groups]
+
+    def __iter__(self):
+        #一个epoch只排一次序，__len__每个step都会调用
+        if self.epoch_batches is None:
+            self.epoch_batches = self.batches()
+        return iter(self.epoch_batches)
+
+    def __len__(self):
+        if self.epoch_batches is None:
+            self.epoch_batches = self.batches()
+        return len(self.epoch_batches)
+
+
+def bucket_collate(batch):
+    """
+    Pads variable-length Mel2Samp items to the longest of the batch, audio
+    with zeros and mels with MEL_PAD_VALUE.  Returns (mel, audio, lengths)
+    with lengths the samples of every item, or (audio, lengths) for
+    audio_only items.
+    """
+    audio_only = torch.is_tensor(batch[0])
+    audios = batch if audio_only else [audio for _, audio in batch]
+    lengths = torch.LongTensor([audio.size(0) for audio in audios])
+    audio = audios[0].new_zeros(len(audios), int(lengths.max()))
+    for j, item in enumerate(audios):
+        audio[j, :item.size(0)] = item
+    if audio_only:
+        return audio, lengths
+    mels = [mel for mel, _ in batch]
+    mel = mels[0].new_full((len(mels), mels[0].size(0),
+                            max(m.size(1) for m in mels)), MEL_PAD_VALUE)
+    for j, item in enumerate(mels):
+        mel[j, :, :item.size(1)] = item
+    return mel, audio, lengths
+
+
 class Mel2Samp(torch.utils.data.Dataset):
     """
     This is the main class that calculates the spectrogram and returns the
     spectrogram, audio pair.
     """
     def __init__(self, training_files, segment_length, filter_length,
-                 hop_length, win_length, sampling_rate, mel_fmin, mel_fmax):
+                 hop_length, win_length, sampling_rate, mel_fmin, mel_fmax,
+                 manifest_path=None, audio_only=False, variable_length=False):
         self.audio_files = files_to_list(training_files)
+        #长度和非静音片段的起点范围从manifest缓存中取，不用每次解码每个wav
+        self.manifest = load_manifest(self.audio_files, manifest_path,
+                                      segment_length=segment_length)
+        self.voiced = {}
         for file in self.audio_files:
-            audio_data, sample_r = load_wav_to_torch(file)
-            if audio_data.size(0) < segment_length:
-                self.audio_files.remove(file)
+            ranges = self.manifest[file]['voiced'][str(segment_length)]
+            if ranges:
+                self.voiced[file] = (ranges, run_counts(ranges))
+        #整段都是静音的文件也去掉，否则__getitem__取不到片段
+        #变长时segment_length是最大长度，短文件整个用，至少一个hop
+        def usable(file):
+            if self.manifest[file]['samples'] >= segment_length:
+                return file in self.voiced
+            return variable_length and self.manifest[file]['samples'] >= hop_length
+        self.audio_files = [file for file in self.audio_files if usable(file)]
         random.seed(1234)
         random.shuffle(self.audio_files)
+        #变长样本的长度（hop的整数倍），给BucketBatchSampler分桶
+        self.variable_length = variable_length
+        self.lengths = [min(self.manifest[file]['samples'], segment_length)
+                        // hop_length * hop_length for file in self.audio_files]
         self.stft = TacotronSTFT(filter_length=filter_length,
                                  hop_length=hop_length,
                                  win_length=win_length,
@@ -80,6 +322,8 @@ class Mel2Samp(torch.utils.data.Dataset):
                                  mel_fmin=mel_fmin, mel_fmax=mel_fmax)
         self.segment_length = segment_length
         self.sampling_rate = sampling_rate
+        #只返回音频，mel在训练时整批在GPU上算（batch_mel）
+        self.audio_only = audio_only
 
     def get_mel(self, audio):
         audio_norm = audio / MAX_WAV_VALUE
@@ -93,26 +337,31 @@ class Mel2Samp(torch.utils.data.Dataset):
     def __getitem__(self, index):
         # Read audio
         filename = self.audio_files[index]
-        audio, sampling_rate = load_wav_to_torch(filename)
-        
-        #预加重
+        #长度和采样率来自manifest，只读需要的片段（带预加重）
+        n_samples = self.manifest[filename]['samples']
+        sampling_rate = self.manifest[filename]['sampling_rate']
 
         if sampling_rate != self.sampling_rate:
             raise ValueError("{} SR doesn't match target {} SR".format(
                 sampling_rate, self.sampling_rate))
 
-        # Take segment
-        if audio.size(0) >= self.segment_length:
-            audio_std = 0
-            while audio_std<1e-5:
-                max_audio_start = audio.size(0) - self.segment_length
-                audio_start = random.randint(0, max_audio_start)
-                segment = audio[audio_start:audio_start+self.segment_length]
-                audio_std =segment.std()
-            audio = segment
+        # Take segment, 直接从非静音的起点中抽
+        if self.variable_length:
+            audio_start = 0
+            if n_samples >= self.segment_length:
+                audio_start = sample_start(*self.voiced[filename])
+            audio, _ = load_wav_segment(filename, audio_start,
+                                        self.lengths[index])
+        elif n_samples >= self.segment_length:
+            audio_start = sample_start(*self.voiced[filename])
+            audio, _ = load_wav_segment(filename, audio_start,
+                                        self.segment_length)
         else:
+            audio, sampling_rate = load_wav_to_torch(filename)
             audio = torch.nn.functional.pad(audio, (0, self.segment_length - audio.size(0)), 'constant').data
-        
+
+        if self.audio_only:
+            return audio / MAX_WAV_VALUE
         mel = self.get_mel(audio)
 
         audio = audio / MAX_WAV_VALUE
@@ -134,11 +383,24 @@ if __name__ == "__main__":
                         help='JSON file for configuration')
     parser.add_argument('-o', '--output_dir', type=str,
                         help='Output directory')
+    parser.add_argument('--store', action='store_true',
+                        help='write all mels into a few memory-mapped shards '
+                             'with an index instead of one .pt per file')
+    parser.add_argument('--num_workers', default=1, type=int,
+                        help='processes computing mels, with --store')
+    parser.add_argument('--shard_mb', default=1024, type=int,
+                        help='approximate size of one shard, with --store')
     args = parser.parse_args()
 
     with open(args.config) as f:
         data = f.read()
     data_config = json.loads(data)["data_config"]
+    if args.store:
+        #inference.py -f 可以直接读这个目录
+        from feature_store import build
+        build(args.filelist_path, data_config, args.output_dir,
+              args.num_workers, args.shard_mb * 2**20, with_audio=False)
+        sys.exit(0)
     mel2samp = Mel2Samp(**data_config)
 
     filepaths = files_to_list(args.filelist_path)
@@ -0,0 +1,113 @@
+import io
+import copy
+import time
+import torch
+from torch.quantization import QuantWrapper, get_default_qconfig, prepare, convert
+from mel2samp import files_to_list
+
+
+def wrap_wn_convs(wn, qconfig):
+    """
+    Puts quant/dequant stubs around start, in_layers, res_skip_layers,
+    cond_layer and end of one WN, the rest of the coupling stays in float
+    """
+    def wrap(conv):
+        wrapper = QuantWrapper(conv)
+        wrapper.qconfig = qconfig
+        return wrapper
+    wn.start = wrap(wn.start)
+    wn.end = wrap(wn.end)
+    wn.cond_layer = wrap(wn.cond_layer)
+    wn.in_layers = torch.nn.ModuleList([wrap(l) for l in wn.in_layers])
+    wn.res_skip_layers = torch.nn.ModuleList([wrap(l) for l in wn.res_skip_layers])
+
+
+def quantize_waveglow(waveglow, calibration_mels, sigma=1.0, backend='fbgemm'):
+    """
+    Returns an int8 copy of a CPU waveglow (weight norm already removed).
+    Every Conv1d of the WN modules gets per-channel int8 weights and int8
+    activations whose ranges are calibrated by running infer on
+    calibration_mels.  PyTorch's dynamic quantization does not cover Conv1d,
+    hence the calibration pass.
+    """
+    torch.backends.quantized.engine = backend
+    qconfig = get_default_qconfig(backend)
+    waveglow = copy.deepcopy(waveglow).cpu().eval()
+    for wn in list(waveglow.WN1) + list(waveglow.WN2):
+        wrap_wn_convs(wn, qconfig)
+    prepare(waveglow, inplace=True)
+    with torch.no_grad():
+        for mel in calibration_mels:
+            waveglow.infer(torch.unsqueeze(mel.float().cpu(), 0), sigma=sigma)
+    convert(waveglow, inplace=True)
+    return waveglow
+
+
+def model_size(model):
+    """Bytes of the serialized state dict, packed int8 weights included"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def compare(float_model, int8_model, mels, sigma=1.0):
+    """
+    Runs both models on every mel with the same noise and prints timing and
+    waveform error per file and in total
+    """
+    total_float, total_int8 = 0.0, 0.0
+    for i, mel in enumerate(mels):
+        mel = torch.unsqueeze(mel.float().cpu(), 0)
+        hop_length = float_model.upsample.stride[0]
+        z = torch.randn(1, float_model.n_group,
+                        mel.size(2)*hop_length // float_model.n_group)
+        with torch.no_grad():
+            st = time.time()
+            audio_float = float_model.infer(mel, sigma=sigma, z=z)
+            time_float = time.time() - st
+            st = time.time()
+            audio_int8 = int8_model.infer(mel, sigma=sigma, z=z)
+            time_int8 = time.time() - st
+        error = audio_int8 - audio_float
+        snr = 10 * torch.log10(audio_float.pow(2).sum() / error.pow(2).sum().clamp(min=1e-12))
+        print("{}: float {:.3f}s int8 {:.3f}s speedup {:.2f}x "
+              "max abs err {:.5f} SNR {:.2f}dB".format(
+                  i, time_float, time_int8, time_float / time_int8,
+                  error.abs().max().item(), snr.item()))
+        total_float += time_float
+        total_int8 += time_int8
+    print("total: float {:.3f}s int8 {:.3f}s speedup {:.2f}x".format(
+        total_float, total_int8, total_float / total_int8))
+    print("model size: float {:.1f}MB int8 {:.1f}MB".format(
+        model_size(float_model) / 2**20, model_size(int8_model) / 2**20))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--waveglow_path', required=True,
+                        help='Path to waveglow decoder checkpoint with model')
+    parser.add_argument('-c', '--calibration_filelist', default='mel_test.txt',
+                        help='mel files used to calibrate activation ranges')
+    parser.add_argument('-f', '--filelist_path', default=None,
+                        help='mel files to compare on, defaults to the calibration list')
+    parser.add_argument("-s", "--sigma", default=1.0, type=float)
+    parser.add_argument("--num_threads", default=0, type=int)
+    parser.add_argument("--backend", default='fbgemm')
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    waveglow = torch.load(args.waveglow_path, map_location='cpu')['model']
+    waveglow = waveglow.remove_weightnorm(waveglow).eval()
+    calibration_mels = [torch.load(f, map_location='cpu')
+                        for f in files_to_list(args.calibration_filelist)]
+    int8_waveglow = quantize_waveglow(waveglow, calibration_mels, args.sigma,
+                                      args.backend)
+    if args.filelist_path is None:
+        mels = calibration_mels
+    else:
+        mels = [torch.load(f, map_location='cpu')
+                for f in files_to_list(args.filelist_path)]
+    compare(waveglow, int8_waveglow, mels, args.sigma)
@@ -0,0 +1,250 @@
+import io
+import json
+import time
+import queue
+import threading
+import numpy as np
+import torch
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from scipy.io.wavfile import write
+from glow import InferenceWorkspace
+from inference import load_waveglow, infer_batch, MAX_WAV_VALUE, PRECISIONS
+
+
+class Request(object):
+    def __init__(self, mel):
+        self.mel = mel
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.audio = None
+        self.error = None
+        self.queue_time = 0.0
+        self.compute_time = 0.0
+        self.batch_size = 0
+
+
+class MicroBatcher(object):
+    """
+    Collects concurrent requests into batches for infer_batch.  A batch is
+    run once it has max_batch_size requests or its oldest request has waited
+    max_wait_ms, whichever comes first.
+    """
+    def __init__(self, waveglow, denoiser, sigma, denoiser_strength, device,
+                 sampling_rate, max_batch_size=8, max_wait_ms=10.0):
+        self.waveglow = waveglow
+        self.sampling_rate = sampling_rate
+        self.denoiser = denoiser
+        self.sigma = sigma
+        self.denoiser_strength = denoiser_strength
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        # only the batching thread runs infer, so it can own the buffers
+        self.workspace = InferenceWorkspace()
+        self.stats = {'requests': 0, 'batches': 0, 'audio_seconds': 0.0,
+                      'queue_seconds': 0.0, 'compute_seconds': 0.0,
+                      'workspace_bytes': 0}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, mel):
+        request = Request(mel)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = batch[0].arrival + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.process(batch)
+
+    def process(self, batch):
+        st = time.time()
+        try:
+            mels = [r.mel.to(self.device) for r in batch]
+            audios = infer_batch(self.waveglow, mels, sigma=self.sigma,
+                                 denoiser=self.denoiser,
+                                 denoiser_strength=self.denoiser_strength,
+                                 workspace=self.workspace)
+            audios = [audio.float().cpu() for audio in audios]
+        except Exception as e:
+            audios = [None] * len(batch)
+            for r in batch:
+                r.error = e
+        compute_time = time.time() - st
+        with self.lock:
+            self.stats['batches'] += 1
+            self.stats['requests'] += len(batch)
+            self.stats['compute_seconds'] += compute_time
+            self.stats['workspace_bytes'] = self.workspace.nbytes()
+            for r, audio in zip(batch, audios):
+                self.stats['queue_seconds'] += st - r.arrival
+                if audio is not None:
+                    self.stats['audio_seconds'] += audio.size(0) / float(
+                        self.sampling_rate)
+        for r, audio in zip(batch, audios):
+            r.audio = audio
+            r.queue_time = st - r.arrival
+            r.compute_time = compute_time
+            r.batch_size = len(batch)
+            r.done.set()
+
+
+def read_mel(body, content_type, n_mel_channels):
+    """
+    A mel posted either as a .npy array or as a torch.save'd tensor, neither
+    of which may contain pickled objects, checked to be n_mel_channels x
+    frames and returned as float32.  Raises ValueError otherwise, before the
+    mel can join (and fail) a batch.
+    """
+    try:
+        if content_type == 'application/x-npy':
+            mel = torch.from_numpy(np.load(io.BytesIO(body), allow_pickle=False))
+        else:
+            mel = torch.load(io.BytesIO(body), map_location='cpu',
+                             weights_only=True)
+    except Exception as e:
+        raise ValueError("could not read the mel: {}".format(e))
+    if not isinstance(mel, torch.Tensor) or mel.is_complex():
+        raise ValueError("the mel must be a real tensor or array")
+    if mel.dim() != 2 or mel.size(0) != n_mel_channels or mel.size(1) == 0:
+        raise ValueError("the mel must be {} x frames, got {}".format(
+            n_mel_channels, 'x'.join(str(n) for n in mel.size())))
+    return mel.float().contiguous()
+
+
+def wav_bytes(audio, sampling_rate):
+    audio = np.clip(audio.numpy() * MAX_WAV_VALUE, -MAX_WAV_VALUE,
+                    MAX_WAV_VALUE - 1).astype('int16')
+    buffer = io.BytesIO()
+    write(buffer, sampling_rate, audio)
+    return buffer.getvalue()
+
+
+class VocoderHandler(BaseHTTPRequestHandler):
+    """
+    POST /synthesize with a mel (n_mel_channels x frames) returns audio/wav,
+    or 400 if the body is not such a mel.
+    X-Queue-Ms, X-Compute-Ms and X-Batch-Size headers carry the timings of
+    the request.  GET /stats returns the aggregate counters as JSON.
+    """
+    batcher = None
+    sampling_rate = 22050
+
+    def address_string(self):
+        # unix socket clients have no (host, port)
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def send_body(self, code, body, content_type, headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with self.batcher.lock:
+                stats = dict(self.batcher.stats)
+            self.send_body(200, json.dumps(stats).encode(), 'application/json')
+        else:
+            self.send_body(404, b'not found', 'text/plain')
+
+    def do_POST(self):
+        if self.path != '/synthesize':
+            self.send_body(404, b'not found', 'text/plain')
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            mel = read_mel(body, self.headers.get('Content-Type'),
+                           self.batcher.waveglow.upsample.in_channels)
+        except ValueError as e:
+            self.send_body(400, str(e).encode(), 'text/plain')
+            return
+        try:
+            request = self.batcher.submit(mel)
+        except Exception as e:
+            self.send_body(500, str(e).encode(), 'text/plain')
+            return
+        self.send_body(200, wav_bytes(request.audio, self.sampling_rate),
+                       'audio/wav',
+                       [('X-Queue-Ms', '{:.2f}'.format(request.queue_time*1000)),
+                        ('X-Compute-Ms', '{:.2f}'.format(request.compute_time*1000)),
+                        ('X-Batch-Size', str(request.batch_size))])
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    import os
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--waveglow_path', required=True,
+                        help='Path to waveglow decoder checkpoint with model')
+    parser.add_argument("-s", "--sigma", default=1.0, type=float)
+    parser.add_argument("--sampling_rate", default=22050, type=int)
+    parser.add_argument("--precision", default='fp32', choices=sorted(PRECISIONS))
+    parser.add_argument("--is_fp16", action="store_true",
+                        help='same as --precision fp16')
+    parser.add_argument("-d", "--denoiser_strength", default=0.0, type=float,
+                        help='Removes model bias. Start with 0.1 and adjust')
+    parser.add_argument("--device", default=None,
+                        help='cuda or cpu, defaults to cuda when available')
+    parser.add_argument("--num_threads", default=0, type=int)
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", default=8080, type=int)
+    parser.add_argument("--unix_socket", default=None,
+                        help='listen on this unix socket path instead of host:port')
+    parser.add_argument("--max_batch_size", default=8, type=int)
+    parser.add_argument("--max_wait_ms", default=10.0, type=float,
+                        help='latency budget for collecting a micro-batch')
+    args = parser.parse_args()
+    if args.is_fp16:
+        args.precision = 'fp16'
+
+    if args.device is None:
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    waveglow, denoiser = load_waveglow(args.waveglow_path, args.device,
+                                       args.precision, args.denoiser_strength)
+    VocoderHandler.batcher = MicroBatcher(waveglow, denoiser, args.sigma,
+                                          args.denoiser_strength, args.device,
+                                          args.sampling_rate,
+                                          args.max_batch_size, args.max_wait_ms)
+    VocoderHandler.sampling_rate = args.sampling_rate
+
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, VocoderHandler)
+        print("Serving on {}".format(args.unix_socket))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), VocoderHandler)
+        print("Serving on {}:{}".format(args.host, args.port))
+    server.serve_forever()
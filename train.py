@@ -38,7 +38,9 @@ from torch.utils.data.distributed import DistributedSampler
 
 from torch.utils.data import DataLoader
 from glow import WaveGlow, WaveGlowLoss
-from mel2samp import Mel2Samp
+from mel2samp import Mel2Samp, batch_mel, BucketBatchSampler, bucket_collate
+from frontend import TacotronSTFT
+from feature_store import FeatureStore
 
 def load_checkpoint(checkpoint_path, model, optimizer):
     assert os.path.isfile(checkpoint_path)
@@ -91,7 +93,8 @@ def validate(model,criterion,valset,epoch,batch_size,n_gpus,rank,output_director
 
 def train(num_gpus, rank, group_name,tnum, output_directory, epochs, learning_rate,
           sigma, iters_per_checkpoint, batch_size, seed, fp16_run,
-          checkpoint_path, with_tensorboard):
+          checkpoint_path, with_tensorboard, feature_store="",
+          mel_on_device=False, max_batch_samples=0):
     #设定随机数以便复现
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
@@ -113,10 +116,8 @@ def train(num_gpus, rank, group_name,tnum, output_directory, epochs, learning_ra
     #=====END:   ADDED FOR DISTRIBUTED======
     #优化器
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
-    #apex加速
-    if fp16_run:
-        from apex import amp
-        model, optimizer = amp.initialize(model, optimizer, opt_level='O1')
+    #autocast混合精度，loss放大防止fp16梯度下溢
+    scaler = torch.cuda.amp.GradScaler(enabled=fp16_run)
 
     # Load checkpoint if one exists
     iteration = 0
@@ -133,18 +134,50 @@ def train(num_gpus, rank, group_name,tnum, output_directory, epochs, learning_ra
         iteration += 1  # next iteration is iteration + 1
     temp_config = copy.deepcopy(data_config)
     temp_config['training_files'] = data_config['training_files'].replace('1',str(tnum))
-    trainset = Mel2Samp(**data_config)
+    if feature_store != "" and max_batch_samples > 0:
+        raise Exception("max_batch_samples needs Mel2Samp, not a feature_store")
+    #manifest缺失或过期时只让rank 0去读整个语料并写入，其他rank等它写完再直接读
+    if num_gpus > 1 and rank != 0:
+        torch.distributed.barrier()
+    if feature_store != "":
+        #从feature_store.py预先算好的mmap特征库中切片，不再读wav和算mel
+        trainset = FeatureStore(feature_store, data_config['segment_length'],
+                                data_config['hop_length'],
+                                data_config['sampling_rate'],
+                                audio_only=mel_on_device)
+    else:
+        trainset = Mel2Samp(audio_only=mel_on_device,
+                            variable_length=max_batch_samples > 0, **data_config)
+    #dataloader只给音频，整批的mel在GPU上一次算出
+    if mel_on_device:
+        stft = TacotronSTFT(filter_length=data_config['filter_length'],
+                            hop_length=data_config['hop_length'],
+                            win_length=data_config['win_length'],
+                            sampling_rate=data_config['sampling_rate'],
+                            mel_fmin=data_config['mel_fmin'],
+                            mel_fmax=data_config['mel_fmax']).cuda()
     testconfig = copy.deepcopy(data_config)
     testconfig["training_files"] = "traintestset_eng/test_files_eng.txt"
     testset = Mel2Samp(**testconfig)
-    # =====START: ADDED FOR DISTRIBUTED======
-    train_sampler = DistributedSampler(trainset) if num_gpus > 1 else None
-    # =====END:   ADDED FOR DISTRIBUTED======
-    train_loader = DataLoader(trainset, num_workers=1, shuffle=False,
-                              sampler=train_sampler,
-                              batch_size=batch_size,
-                              pin_memory=False,
-                              drop_last=True)
+    if num_gpus > 1 and rank == 0:
+        torch.distributed.barrier()
+    if max_batch_samples > 0:
+        #变长训练：长度相近的样本分一桶，每个batch的总采样点数不超过max_batch_samples
+        train_sampler = BucketBatchSampler(trainset.lengths, max_batch_samples,
+                                           num_gpus, rank, seed)
+        train_loader = DataLoader(trainset, num_workers=1,
+                                  batch_sampler=train_sampler,
+                                  collate_fn=bucket_collate,
+                                  pin_memory=False)
+    else:
+        # =====START: ADDED FOR DISTRIBUTED======
+        train_sampler = DistributedSampler(trainset) if num_gpus > 1 else None
+        # =====END:   ADDED FOR DISTRIBUTED======
+        train_loader = DataLoader(trainset, num_workers=1, shuffle=False,
+                                  sampler=train_sampler,
+                                  batch_size=batch_size,
+                                  pin_memory=False,
+                                  drop_last=True)
 
     # Get shared output_directory ready
     if rank == 0:
@@ -165,29 +198,39 @@ def train(num_gpus, rank, group_name,tnum, output_directory, epochs, learning_ra
     # ================ MAIN TRAINNIG LOOP! ===================
     for epoch in range(epoch_offset, epochs):
         print("Epoch: {}".format(epoch))
+        if max_batch_samples > 0:
+            train_sampler.set_epoch(epoch)
         for i, batch in enumerate(train_loader):
             #梯度置0，z符合高斯0分布
             model.zero_grad()
             #mel=batch*80*63,batch*16000
-            mel, audio = batch
-            #封装数据
-            mel = torch.autograd.Variable(mel.cuda())
-            audio = torch.autograd.Variable(audio.cuda())
-            outputs = model((mel, audio))
-            #计算loss
+            #变长batch的最后一项是每条音频的采样点数
+            lengths = None
+            if max_batch_samples > 0:
+                lengths = batch[-1].cuda()
+                batch = batch[0] if mel_on_device else batch[:-1]
+            if mel_on_device:
+                audio = batch.cuda()
+                mel = batch_mel(stft, audio)
+            else:
+                mel, audio = batch
+                #封装数据
+                mel = torch.autograd.Variable(mel.cuda())
+                audio = torch.autograd.Variable(audio.cuda())
+            with torch.cuda.amp.autocast(enabled=fp16_run):
+                if lengths is None:
+                    outputs = model((mel, audio))
+                else:
+                    outputs = model((mel, audio, lengths))
+            #计算loss，在autocast外用fp32算
             loss = criterion(outputs)
             if num_gpus > 1:
                 reduced_loss = reduce_tensor(loss.data, num_gpus).item()
             else:
                 reduced_loss = loss.item()
-            #apex加速还原
-            if fp16_run:
-                with amp.scale_loss(loss, optimizer) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
-
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             
             if not reduced_loss < 0:
                 print("no")
@@ -0,0 +1,72 @@
+import json
+import numpy as np
+import torch
+
+
+class Vocoder(object):
+    """
+    Runs a graph written by export_model.py.  Only needs torch (TorchScript)
+    or onnxruntime (ONNX), not glow.py or the checkpoint.
+    """
+    def __init__(self, path, device='cpu'):
+        with open(path + '.json') as f:
+            config = json.load(f)
+        self.n_group = config['n_group']
+        self.hop_length = config['hop_length']
+        self.format = config['format']
+        self.device = device
+        if self.format == 'torchscript':
+            self.graph = torch.jit.load(path, map_location=device)
+        elif self.format == 'onnx':
+            import onnxruntime
+            self.graph = onnxruntime.InferenceSession(
+                path, providers=['CPUExecutionProvider'])
+        else:
+            raise Exception("Format {} is not supported".format(self.format))
+
+    def __call__(self, spect, sigma=1.0):
+        """
+        spect: batch x n_mel_channels x frames, returns batch x
+        frames*hop_length audio in [-1, 1] as a tensor
+        """
+        if spect.dim() == 2:
+            spect = torch.unsqueeze(spect, 0)
+        z = sigma * torch.randn(spect.size(0), self.n_group,
+                                spect.size(2)*self.hop_length // self.n_group)
+        if self.format == 'onnx':
+            audio = self.graph.run(['audio'], {'spect': spect.float().cpu().numpy(),
+                                               'z': z.numpy()})[0]
+            return torch.from_numpy(audio)
+        with torch.no_grad():
+            return self.graph(spect.to(self.device),
+                              z.to(device=self.device, dtype=spect.dtype))
+
+
+if __name__ == '__main__':
+    import os
+    import argparse
+    from scipy.io.wavfile import write
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--exported_path', required=True,
+                        help='Graph written by export_model.py')
+    parser.add_argument('-f', '--filelist_path', required=True)
+    parser.add_argument('-o', '--output_dir', required=True)
+    parser.add_argument('-s', '--sigma', default=1.0, type=float)
+    parser.add_argument('--sampling_rate', default=22050, type=int)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    vocoder = Vocoder(args.exported_path, args.device)
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    with open(args.filelist_path, encoding='utf-8') as f:
+        mel_files = [line.rstrip() for line in f if line.strip()]
+    for file_path in mel_files:
+        audio = vocoder(torch.load(file_path), sigma=args.sigma)
+        audio = np.clip(audio.squeeze().float().cpu().numpy() * 32768.0,
+                        -32768, 32767).astype('int16')
+        file_name = os.path.splitext(os.path.basename(file_path))[0]
+        audio_path = os.path.join(args.output_dir, file_name)
+        write(audio_path, args.sampling_rate, audio)
+        print(audio_path)